@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Throughput benchmarks of the larpixtools codec and HDF5 I/O, run on
+# test/example-pacman-data.h5 (optionally scaled up by replicating its
+# packets). Results are written as JSON; with --compare the run is checked
+# against a stored baseline and slowdowns beyond --threshold are flagged.
+#
+#   python bench_larpixtools.py --output baseline.json
+#   python bench_larpixtools.py --compare baseline.json
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+import h5py
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.join(bench_dir, '../scripts'))
+import larpixtools
+
+default_input_file = os.path.join(bench_dir, '../test/example-pacman-data.h5')
+
+def timeit(func, repeat):
+    # best wall-clock time of repeat calls, after one untimed warm-up call
+    func()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def scaled_file(input_file, scale, tmp_dir):
+    # input_file with its packets repeated scale times, in the 2.4 layout
+    if scale == 1:
+        return input_file
+    with h5py.File(input_file, 'r') as f:
+        packets = f['packets'][:]
+    filename = os.path.join(tmp_dir, 'scaled-x{}.h5'.format(scale))
+    with larpixtools.PacketFileWriter(filename, version='2.4', mode='w') as writer:
+        for _ in range(scale):
+            writer.append(packets)
+    return filename
+
+def benchmarks(filename, object_rows, tmp_dir):
+    # returns a list of (name, setup) of every benchmark, setup() returns
+    # (items, bytes, function). Inputs are built on first use and shared by
+    # the benchmarks using them, so --only only pays for its own setup.
+    inputs = dict()
+
+    def shared(build):
+        def get():
+            if build not in inputs:
+                inputs[build] = build()
+            return inputs[build]
+        return get
+
+    @shared
+    def packets():
+        with h5py.File(filename, 'r') as f:
+            return f['packets'][:]
+
+    @shared
+    def objects():
+        return larpixtools.from_file(filename, end=object_rows)['packets']
+
+    @shared
+    def larpix_objects():
+        return [p for p in objects() if isinstance(p, larpixtools.Packet_v2)]
+
+    @shared
+    def words():
+        return larpixtools.packets_to_words(packets())[0]
+
+    @shared
+    def raw():
+        return words()['packet'][words()['word_type'] == larpixtools.WORD_TYPE_DATA].copy()
+
+    @shared
+    def raw_bytes():
+        return [packet.tobytes() for packet in raw()[:object_rows]]
+
+    @shared
+    def msg():
+        return larpixtools.format(larpix_objects(), msg_type='DATA')
+
+    @shared
+    def msg_words():
+        return larpixtools.parse_msg(msg())[1]
+
+    @shared
+    def msgs():
+        return larpixtools.hdf5_to_msgs(filename)[0]
+
+    @shared
+    def trigger_ts():
+        clocked = larpixtools._timed_rows(packets(), 'timestamp')
+        return np.linspace(packets()['timestamp'][clocked].min(),
+            packets()['timestamp'][clocked].max(), 10000).astype(np.int64)
+
+    def n_rows():
+        return len(packets())
+
+    def n_bytes():
+        return len(packets()) * packets().dtype.itemsize
+
+    def write_file():
+        out_file = os.path.join(tmp_dir, 'bench-out.h5')
+        with larpixtools.PacketFileWriter(out_file, mode='w') as writer:
+            writer.append(packets())
+
+    def access_properties():
+        for p in larpix_objects():
+            p.timestamp, p.chip_id, p.channel_id, p.dataword, p.chip_key
+
+    return [
+        # object path
+        ('from_file', lambda: (len(objects()), len(objects()) * packets().dtype.itemsize,
+            lambda: larpixtools.from_file(filename, end=object_rows))),
+        ('format', lambda: (len(larpix_objects()), len(msg()),
+            lambda: larpixtools.format(larpix_objects(), msg_type='DATA'))),
+        ('format_msg', lambda: (len(msg_words()), len(msg()),
+            lambda: larpixtools.format_msg('DATA', msg_words()))),
+        ('parse_msg', lambda: (len(msg_words()), len(msg()),
+            lambda: larpixtools.parse_msg(msg()))),
+        ('parse', lambda: (len(msg_words()), len(msg()),
+            lambda: larpixtools.parse(msg(), io_group=1))),
+        ('Packet_v2', lambda: (len(raw_bytes()), 8 * len(raw_bytes()),
+            lambda: [larpixtools.Packet_v2(b) for b in raw_bytes()])),
+        ('Packet_v2_properties', lambda: (len(larpix_objects()), 8 * len(larpix_objects()),
+            access_properties)),
+
+        # array path
+        ('from_file_fields', lambda: (n_rows(), n_rows() * 12,
+            lambda: larpixtools.from_file(filename,
+                fields=['timestamp', 'chip_id', 'channel_id', 'dataword', 'io_group']))),
+        ('iter_file', lambda: (n_rows(), n_bytes(),
+            lambda: [chunk for chunk in larpixtools.iter_file(filename)])),
+        ('decode_packets_v2', lambda: (len(raw()), 8 * len(raw()),
+            lambda: larpixtools.decode_packets_v2(raw()))),
+        ('decode_packet_fields', lambda: (len(raw()), 8 * len(raw()),
+            lambda: larpixtools.decode_packet_fields(raw()))),
+        ('valid_parity', lambda: (len(raw()), 8 * len(raw()),
+            lambda: larpixtools.valid_parity(raw()))),
+        ('check_parity', lambda: (n_rows(), n_bytes(),
+            lambda: larpixtools.check_parity(packets()))),
+        ('packets_to_words', lambda: (n_rows(), n_bytes(),
+            lambda: larpixtools.packets_to_words(packets()))),
+        ('hdf5_to_msgs', lambda: (n_rows(), len(msgs()),
+            lambda: larpixtools.hdf5_to_msgs(filename))),
+        ('segment_msgs', lambda: (n_rows(), n_bytes(),
+            lambda: larpixtools.segment_msgs(packets()))),
+        ('walk_msgs', lambda: (len(words()), len(msgs()),
+            lambda: larpixtools.walk_msgs(msgs()))),
+        ('msg_to_packets', lambda: (len(msg_words()), len(msg()),
+            lambda: larpixtools.msg_to_packets(msg(), io_group=1))),
+        ('group_by_chip', lambda: (n_rows(), n_bytes(),
+            lambda: larpixtools.group_by_chip(packets()))),
+        ('unwrap_timestamps', lambda: (n_rows(), n_bytes(),
+            lambda: larpixtools.unwrap_timestamps(packets()))),
+        ('extract_windows', lambda: (len(trigger_ts()), n_bytes(),
+            lambda: larpixtools.extract_windows(packets(), trigger_ts(), 2500000, 2500000))),
+        ('PacketFileWriter', lambda: (n_rows(), n_bytes(), write_file)),
+        ]
+
+def run(input_file, scale, repeat, object_rows, only=None):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = scaled_file(input_file, scale, tmp_dir)
+        for name, setup in benchmarks(filename, object_rows, tmp_dir):
+            if only and name not in only:
+                continue
+            n_items, n_bytes, func = setup()
+            seconds = timeit(func, repeat)
+            results[name] = dict(seconds=seconds, items=n_items, bytes=n_bytes,
+                items_per_s=n_items / seconds, bytes_per_s=n_bytes / seconds)
+            print('{:<24} {:>12.0f} items/s {:>10.2f} MB/s'.format(
+                name, n_items / seconds, n_bytes / seconds / 1e6))
+    return dict(
+        meta=dict(
+            input_file=os.path.basename(input_file), scale=scale, repeat=repeat,
+            object_rows=object_rows, created=time.time(),
+            python=platform.python_version(), numpy=np.__version__,
+            h5py=h5py.__version__, machine=platform.machine(),
+            larpix_c=larpixtools.load_larpix_c() is not None),
+        results=results)
+
+def compare(report, baseline, threshold):
+    # prints the per benchmark speed ratio to the baseline, returns the names
+    # of benchmarks slower by more than threshold
+    slower = []
+    for key in ('input_file', 'scale', 'object_rows'):
+        if report['meta'][key] != baseline['meta'].get(key):
+            print('Warning: {} differs from the baseline ({} vs {})'.format(
+                key, report['meta'][key], baseline['meta'].get(key)))
+    print('{:<24} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline/s', 'current/s', 'ratio'))
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            print('{:<24} {:>14} {:>14.0f} {:>8}'.format(name, '-', result['items_per_s'], 'new'))
+            continue
+        reference = baseline['results'][name]['items_per_s']
+        ratio = result['items_per_s'] / reference
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = 'SLOWER'
+            slower.append(name)
+        print('{:<24} {:>14.0f} {:>14.0f} {:>8.2f} {}'.format(
+            name, reference, result['items_per_s'], ratio, flag))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='larpixtools benchmarks')
+    parser.add_argument('--input_file', default=default_input_file,
+        help='larpix HDF5 file to benchmark on')
+    parser.add_argument('--scale', type=int, default=1,
+        help='Replicate the input packets this many times (synthetic data set)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark, best is kept')
+    parser.add_argument('--object_rows', type=int, default=20000,
+        help='Rows used by the (slow) packet object benchmarks')
+    parser.add_argument('--only', nargs='*', help='Run only these benchmarks')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='Relative slowdown flagged in compare mode')
+    args = parser.parse_args()
+
+    report = run(args.input_file, args.scale, args.repeat, args.object_rows, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compare(report, baseline, args.threshold)
+        if slower:
+            print('Slower than baseline:', ', '.join(slower))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -85,17 +85,11 @@ data_file = f"{lbrulibs_dir}/test/example-pacman-data.h5"
 
 def hdf5ToPackets(datafile): 
     print("Reading from:",datafile)
-    packets = larpixtools.from_file(datafile)['packets'] #read from HDF5 file
-    print("Separating into messages based on timestamp packets...")
-    msg_breaks = [i for i in range(len(packets)) if packets[i].packet_type == 0 or i == len(packets)-1] #find the timestamp packets which signify message breaks
-    msg_packets = [packets[i:j] for i,j in zip(msg_breaks[:-1], msg_breaks[1:])] #separate into messages
-    msgs = [larpixtools.format(p, msg_type='DATA') for p in msg_packets]
-    print("Extracting headers and words from messages...")
-    word_lists = [larpixtools.parse_msg(p)[1] for p in msgs] #retrieve lists of words from each message
+    messages = larpixtools.pacman_msg_cache(datafile)
     print("Read complete. PACMAN style messages prepared.")
-    return word_lists
+    return messages
 
-def sender(_data_server,word_lists):
+def sender(_data_server,messages):
     try:
         # Set up sockets
         print("Setting up ZMQ sockets...")
@@ -126,8 +120,10 @@ def sender(_data_server,word_lists):
         time.sleep(1)
 
         print('Sending PACMAN data.')
-        for i in word_lists:
-            data_socket.send_multipart([id,larpixtools.format_msg('DATA',i)])
+        for msg in larpixtools.iter_msgs(*messages):
+            msg = bytearray(msg) # the cached messages are read-only
+            larpixtools.set_msg_unix_ts(msg)
+            data_socket.send_multipart([id,msg])
             time.sleep(0.1)
     except:
         raise
@@ -136,10 +132,10 @@ def sender(_data_server,word_lists):
         ctx.destroy()
 
 
-word_lists = hdf5ToPackets(data_file)
+messages = hdf5ToPackets(data_file)
 print("Starting PACMAN card(s)")
 import multiprocessing
-process = multiprocessing.Process(target=sender,args=[data_socket,word_lists])
+process = multiprocessing.Process(target=sender,args=[data_socket,messages])
 process.daemon = True
 process.start()
 
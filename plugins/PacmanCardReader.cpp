@@ -14,6 +14,7 @@
 
 #include <chrono>
 #include <memory>
+#include <set>
 #include <string>
 #include <thread>
 #include <utility>
@@ -66,6 +67,7 @@ PacmanCardReader::init(const data_t& args)
 {
   auto ini = args.get<appfwk::app::ModInit>();
   TLOG(TLVL_WORK_STEPS) << "ini";
+  int link_id = 0;
   for (const auto& cr : ini.conn_refs) {
 
     TLOG(TLVL_WORK_STEPS) << "PacmanCardReader output queue is " << cr.uid;
@@ -74,22 +76,21 @@ PacmanCardReader::init(const data_t& args)
     std::vector<std::string> words;
     tokenize(target, delim, words);
     if (usePUBSUB) {
-      TLOG(TLVL_WORK_STEPS) << "Creating ZMQLinkModel for target queue: " << target;
-      m_zmqlink[0] =
-        createZMQLinkModel(cr.uid); // FIX ME - need to resolve proper link ID rather than hard code to zero
-      if (m_zmqlink[0] == nullptr) {
+      TLOG(TLVL_WORK_STEPS) << "Creating ZMQLinkModel " << link_id << " for target queue: " << target;
+      m_zmqlink[link_id] = createZMQLinkModel(cr.uid);
+      if (m_zmqlink[link_id] == nullptr) {
         ers::fatal(InitializationError(ERS_HERE, "CreateZMQLink failed to provide an appropriate model for queue!"));
       }
-      m_zmqlink[0]->init(args, m_queue_capacity);
+      m_zmqlink[link_id]->init(args, m_queue_capacity);
     } else {
-      TLOG(TLVL_WORK_STEPS) << "Creating STREAMLinkModel for target queue: " << target;
-      m_streamlink[0] =
-        createSTREAMLinkModel(cr.uid); // FIX ME - need to resolve proper link ID rather than hard code to zero
-      if (m_streamlink[0] == nullptr) {
+      TLOG(TLVL_WORK_STEPS) << "Creating STREAMLinkModel " << link_id << " for target queue: " << target;
+      m_streamlink[link_id] = createSTREAMLinkModel(cr.uid);
+      if (m_streamlink[link_id] == nullptr) {
         ers::fatal(InitializationError(ERS_HERE, "CreateSTREAMLink failed to provide an appropriate model for queue!"));
       }
-      m_streamlink[0]->init(args, m_queue_capacity);
+      m_streamlink[link_id]->init(args, m_queue_capacity);
     }
+    ++link_id;
   }
 
   m_cfg = args.get<pacmancardreader::Conf>();
@@ -101,24 +102,58 @@ PacmanCardReader::do_configure(const data_t& args)
   m_cfg = args.get<pacmancardreader::Conf>();
   m_card_id = m_cfg.card_id;
 
-  // Config checks - make some if config values needed, felix example below
-  //
-  // if (m_num_links != m_elinks.size()) {
-  //  ers::fatal(ElinkConfigurationInconsistency(ERS_HERE, m_num_links));
-  //}
-  //
+  // One link configuration per output queue. Only a single link may go without
+  // one (it uses the default endpoint), several links need their endpoints
+  // given explicitly and no two links may share an endpoint.
+  const size_t num_links = usePUBSUB ? m_zmqlink.size() : m_streamlink.size();
+  if (m_cfg.link_confs.empty() && num_links > 1) {
+    throw InitializationError(ERS_HERE,
+                              "No link configurations given for " + std::to_string(num_links) +
+                                " output queues, each link needs its own endpoint!");
+  }
+  if (!m_cfg.link_confs.empty() && m_cfg.link_confs.size() != num_links) {
+    throw InitializationError(ERS_HERE,
+                              "Number of link configurations (" + std::to_string(m_cfg.link_confs.size()) +
+                                ") does not match the number of output queues (" + std::to_string(num_links) + ")!");
+  }
+  std::vector<std::string> endpoints;
+  std::set<std::string> used_endpoints;
+  for (size_t link_id = 0; link_id < num_links; ++link_id) {
+    if (m_cfg.link_confs.empty()) {
+      endpoints.push_back(pacmancardreader::LinkConfiguration().endpoint);
+    } else {
+      endpoints.push_back(m_cfg.link_confs[link_id].endpoint);
+    }
+    if (!used_endpoints.insert(endpoints.back()).second) {
+      throw InitializationError(ERS_HERE,
+                                "Endpoint " + endpoints.back() + " of link " + std::to_string(link_id) +
+                                  " is already used by another link!");
+    }
+  }
 
   // Configure components
   TLOG(TLVL_WORK_STEPS) << "Configuring LinkHandler";
   if (usePUBSUB) {
     TLOG(TLVL_WORK_STEPS) << "Using ZMQ Publish/Subscribe";
-    m_zmqlink[0]->set_ids(m_card_id, 0);
-    m_zmqlink[0]->conf(args);
+    for (auto& [link_id, link] : m_zmqlink) {
+      link->set_ids(m_card_id, link_id);
+      link->set_source_link(endpoints[link_id]);
+      if (!m_cfg.link_confs.empty()) {
+        link->set_cpu_core(m_cfg.link_confs[link_id].cpu_core);
+      }
+      link->conf(args);
+    }
   } else {
     TLOG(TLVL_WORK_STEPS) << "Using Raw TCP Stream";
-    m_streamlink[0]->set_ids(m_card_id, 0);
-    TLOG(TLVL_WORK_STEPS) << "apply conf";
-    m_streamlink[0]->conf(args);
+    for (auto& [link_id, link] : m_streamlink) {
+      link->set_ids(m_card_id, link_id);
+      link->set_source_link(endpoints[link_id]);
+      if (!m_cfg.link_confs.empty()) {
+        link->set_cpu_core(m_cfg.link_confs[link_id].cpu_core);
+      }
+      TLOG(TLVL_WORK_STEPS) << "apply conf for link " << link_id;
+      link->conf(args);
+    }
     TLOG(TLVL_WORK_STEPS) << "finish conf";
   }
 }
@@ -127,9 +162,13 @@ void
 PacmanCardReader::do_start(const data_t& args)
 {
   if (usePUBSUB) {
-    m_zmqlink[0]->start(args);
+    for (auto& [link_id, link] : m_zmqlink) {
+      link->start(args);
+    }
   } else {
-    m_streamlink[0]->start(args);
+    for (auto& [link_id, link] : m_streamlink) {
+      link->start(args);
+    }
   }
 }
 
@@ -137,19 +176,32 @@ void
 PacmanCardReader::do_stop(const data_t& args)
 {
   if (usePUBSUB) {
-    m_zmqlink[0]->stop(args);
+    for (auto& [link_id, link] : m_zmqlink) {
+      link->stop(args);
+    }
   } else {
-    m_streamlink[0]->stop(args);
+    for (auto& [link_id, link] : m_streamlink) {
+      link->stop(args);
+    }
   }
 }
 
 void
 PacmanCardReader::get_info(opmonlib::InfoCollector& ci, int level)
 {
+  // ZMQLinkInfo of each link goes into its own child collector
   if (usePUBSUB) {
-    m_zmqlink[0]->get_info(ci, level);
+    for (auto& [link_id, link] : m_zmqlink) {
+      opmonlib::InfoCollector link_ci;
+      link->get_info(link_ci, level);
+      ci.add("link_" + std::to_string(link_id), link_ci);
+    }
   } else {
-    m_streamlink[0]->get_info(ci, level);
+    for (auto& [link_id, link] : m_streamlink) {
+      opmonlib::InfoCollector link_ci;
+      link->get_info(link_ci, level);
+      ci.add("link_" + std::to_string(link_id), link_ci);
+    }
   }
 }
 
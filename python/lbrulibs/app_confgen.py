@@ -50,6 +50,17 @@ def generate(
     RUN_NUMBER=333,
     DATA_FILE="./frames.bin",
     TP_DATA_FILE="./tp_frames.bin",
+    ZMQ_RCVHWM=1000,
+    ZMQ_RCVBUF=-1,
+    ZMQ_IO_THREADS=1,
+    ZMQ_IO_THREAD_CPUS=None,
+    TCP_KEEPALIVE=-1,
+    TCP_KEEPALIVE_IDLE=-1,
+    TCP_KEEPALIVE_CNT=-1,
+    TCP_KEEPALIVE_INTVL=-1,
+    BASE_PORT=5556,
+    PORT_STRIDE=1,
+    LINK_CPU_CORES=None,
 ):
 
     # Define modules and queues
@@ -248,22 +259,24 @@ def generate(
             (
                 "fake_source",
                 pcr.Conf(
+                    # one link per output queue of fake_source
                     link_confs=[
                         pcr.LinkConfiguration(
-                            geoid=pcr.GeoID(system="kNDLarTPC", region=0, element=idx),
+                            Source_ID=idx,
+                            endpoint=f"tcp://127.0.0.1:{BASE_PORT + idx * PORT_STRIDE}",
+                            cpu_core=LINK_CPU_CORES[idx] if LINK_CPU_CORES and idx < len(LINK_CPU_CORES) else -1,
                         )
                         for idx in range(NUMBER_OF_DATA_PRODUCERS)
-                    ]
-                    + [
-                        pcr.LinkConfiguration(
-                            geoid=sec.GeoID(system="TPC", region=0, element=idx),
-                        )
-                        for idx in range(
-                            NUMBER_OF_DATA_PRODUCERS,
-                            NUMBER_OF_DATA_PRODUCERS + NUMBER_OF_TP_PRODUCERS,
-                        )
                     ],
                     # input_limit=10485100, # default
+                    zmq_rcvhwm=ZMQ_RCVHWM,
+                    zmq_rcvbuf=ZMQ_RCVBUF,
+                    zmq_io_threads=ZMQ_IO_THREADS,
+                    zmq_io_thread_cpus=ZMQ_IO_THREAD_CPUS or [],
+                    tcp_keepalive=TCP_KEEPALIVE,
+                    tcp_keepalive_idle=TCP_KEEPALIVE_IDLE,
+                    tcp_keepalive_cnt=TCP_KEEPALIVE_CNT,
+                    tcp_keepalive_intvl=TCP_KEEPALIVE_INTVL,
                 ),
             ),
         ]
@@ -500,6 +513,17 @@ if __name__ == "__main__":
     @click.option("-r", "--run-number", default=333)
     @click.option("-d", "--data-file", type=click.Path(), default="./frames.bin")
     @click.option("--tp-data-file", type=click.Path(), default="./tp_frames.bin")
+    @click.option("--zmq-rcvhwm", default=1000, help="ZMQ receive high water mark (messages)")
+    @click.option("--zmq-rcvbuf", default=-1, help="Kernel receive buffer size in bytes, -1 for OS default")
+    @click.option("--zmq-io-threads", default=1, help="Number of ZMQ I/O threads per link")
+    @click.option("--zmq-io-thread-cpus", multiple=True, type=int, help="CPU core for the ZMQ I/O threads, can be repeated")
+    @click.option("--tcp-keepalive", default=-1, help="TCP keepalive: 1 on, 0 off, -1 for OS default")
+    @click.option("--tcp-keepalive-idle", default=-1)
+    @click.option("--tcp-keepalive-cnt", default=-1)
+    @click.option("--tcp-keepalive-intvl", default=-1)
+    @click.option("--base-port", default=5556, help="Port of the first link")
+    @click.option("--port-stride", default=1, help="Port offset between consecutive links, link n listens on base port + n * stride")
+    @click.option("--link-cpu-cores", multiple=True, type=int, help="CPU core for the parser thread of each link in order, can be repeated")
     @click.argument("json_file", type=click.Path(), default="fake_NDreadout.json")
     def cli(
         frontend_type,
@@ -510,6 +534,17 @@ if __name__ == "__main__":
         run_number,
         data_file,
         tp_data_file,
+        zmq_rcvhwm,
+        zmq_rcvbuf,
+        zmq_io_threads,
+        zmq_io_thread_cpus,
+        tcp_keepalive,
+        tcp_keepalive_idle,
+        tcp_keepalive_cnt,
+        tcp_keepalive_intvl,
+        base_port,
+        port_stride,
+        link_cpu_cores,
         json_file,
     ):
         """
@@ -528,6 +563,17 @@ if __name__ == "__main__":
                     RUN_NUMBER=run_number,
                     DATA_FILE=data_file,
                     TP_DATA_FILE=tp_data_file,
+                    ZMQ_RCVHWM=zmq_rcvhwm,
+                    ZMQ_RCVBUF=zmq_rcvbuf,
+                    ZMQ_IO_THREADS=zmq_io_threads,
+                    ZMQ_IO_THREAD_CPUS=list(zmq_io_thread_cpus),
+                    TCP_KEEPALIVE=tcp_keepalive,
+                    TCP_KEEPALIVE_IDLE=tcp_keepalive_idle,
+                    TCP_KEEPALIVE_CNT=tcp_keepalive_cnt,
+                    TCP_KEEPALIVE_INTVL=tcp_keepalive_intvl,
+                    BASE_PORT=base_port,
+                    PORT_STRIDE=port_stride,
+                    LINK_CPU_CORES=list(link_cpu_cores),
                 )
             )
 
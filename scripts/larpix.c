@@ -4,8 +4,8 @@
 
 /* ~~~ Access into message header and message contents ~~~ */
 
-#define WORD_LEN   8  // bytes
-#define HEADER_LEN 16 // bytes
+#define WORD_LEN   16 // bytes
+#define HEADER_LEN 8  // bytes
 
 const uint32_t get_msg_bytes(void* msg) {
     // get total number of bytes in message, including header
@@ -41,7 +41,7 @@ void* get_msg_word(void* msg, const uint32_t i) {
 
 #define WORD_TYPE_OFFSET         0 // bytes
 #define IO_CHANNEL_OFFSET        1 // bytes
-#define RECEIPT_TIMESTAMP_OFFSET 4 // bytes
+#define RECEIPT_TIMESTAMP_OFFSET 2 // bytes
 #define PACKET_OFFSET            8 // bytes
 
 uint8_t* get_word_type(void* word) {
@@ -76,7 +76,7 @@ const uint64_t get_packet_type(uint64_t* packet) {
    return get_packet_data(packet, PACKET_TYPE_OFFSET, PACKET_TYPE_MASK);
 }
 
-#define PACKET_CHIPID_OFFSET 8    // bits
+#define PACKET_CHIPID_OFFSET 2    // bits
 #define PACKET_CHIPID_MASK   0xFF // bitmask
 const uint64_t get_packet_chipid(uint64_t* packet) {
     // bits [2:9]
@@ -93,7 +93,7 @@ const uint64_t get_packet_channelid(uint64_t* packet) {
 #define PACKET_TIMESTAMP_OFFSET 16         // bits
 #define PACKET_TIMESTAMP_MASK   0x7FFFFFFF // bitmask
 const uint64_t get_packet_timestamp(uint64_t* packet) {
-    // bits [46:16], only valid for data packets
+    // bits [16:46], only valid for data packets
     return get_packet_data(packet, PACKET_TIMESTAMP_OFFSET, PACKET_TIMESTAMP_MASK);
 }
 
@@ -145,3 +145,70 @@ const uint64_t get_packet_parity_bit(uint64_t* packet) {
     // bits [63], only valid for data packets
     return get_packet_data(packet, PACKET_PARITY_BIT_MARKER_OFFSET, PACKET_PARITY_BIT_MARKER_MASK);
 }
+
+
+/* ~~~ Bulk access over buffers of back to back messages ~~~ */
+
+const int64_t count_msg_words(void* buf, const uint64_t nbytes, uint64_t* n_msgs) {
+    // count the words (and messages) in a buffer of concatenated messages,
+    // -1 if the last message is truncated
+    uint64_t offset = 0;
+    int64_t n_words = 0;
+    *n_msgs = 0;
+    while (offset + HEADER_LEN <= nbytes) {
+        void* msg = (void*)(((uint8_t*)buf) + offset);
+        offset += get_msg_bytes(msg);
+        if (offset > nbytes) return -1;
+        n_words += *get_msg_words(msg);
+        (*n_msgs)++;
+    }
+    if (offset != nbytes) return -1;
+    return n_words;
+}
+
+const uint64_t walk_msgs(void* buf, const uint64_t nbytes, const uint64_t max_words,
+                         uint8_t* words, uint32_t* msg_index, uint32_t* unix_ts) {
+    // copy up to max_words words of a buffer of concatenated messages into
+    // words (WORD_LEN bytes each), recording for each word the index and unix
+    // timestamp of its message, returns the number of words copied
+    uint64_t offset = 0;
+    uint64_t n_words = 0;
+    uint32_t i_msg = 0;
+    while (offset + HEADER_LEN <= nbytes && n_words < max_words) {
+        void* msg = (void*)(((uint8_t*)buf) + offset);
+        const uint32_t msg_bytes = get_msg_bytes(msg);
+        if (offset + msg_bytes > nbytes) break;
+        const uint16_t msg_words = *get_msg_words(msg);
+        for (uint32_t i = 0; i < msg_words && n_words < max_words; i++, n_words++) {
+            const uint8_t* word = (const uint8_t*)get_msg_word(msg, i);
+            for (uint32_t j = 0; j < WORD_LEN; j++) words[WORD_LEN * n_words + j] = word[j];
+            msg_index[n_words] = i_msg;
+            unix_ts[n_words] = *get_msg_unix_ts(msg);
+        }
+        offset += msg_bytes;
+        i_msg++;
+    }
+    return n_words;
+}
+
+void decode_packets(uint64_t* packets, const uint64_t n, uint8_t* packet_type,
+                    uint8_t* chipid, uint8_t* channelid, uint64_t* timestamp,
+                    uint8_t* first_packet, uint8_t* dataword, uint8_t* trigger_type,
+                    uint8_t* local_fifo, uint8_t* shared_fifo,
+                    uint8_t* downstream_marker, uint8_t* parity) {
+    // fill one array per packet field
+    for (uint64_t i = 0; i < n; i++) {
+        uint64_t* packet = packets + i;
+        packet_type[i]       = get_packet_type(packet);
+        chipid[i]            = get_packet_chipid(packet);
+        channelid[i]         = get_packet_channelid(packet);
+        timestamp[i]         = get_packet_timestamp(packet);
+        first_packet[i]      = get_packet_first_packet(packet);
+        dataword[i]          = get_packet_dataword(packet);
+        trigger_type[i]      = get_packet_trigger_type(packet);
+        local_fifo[i]        = get_packet_local_fifo_status(packet);
+        shared_fifo[i]       = get_packet_shared_fifo_status(packet);
+        downstream_marker[i] = get_packet_downstream_marker(packet);
+        parity[i]            = get_packet_parity_bit(packet);
+    }
+}
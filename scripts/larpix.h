@@ -47,4 +47,13 @@ const uint64_t get_packet_shared_fifo_status(uint64_t* packet);
 const uint64_t get_packet_downstream_marker(uint64_t* packet);
 const uint64_t get_packet_parity_bit(uint64_t* packet);
 
+const int64_t  count_msg_words(void* buf, const uint64_t nbytes, uint64_t* n_msgs);
+const uint64_t walk_msgs(void* buf, const uint64_t nbytes, const uint64_t max_words,
+                         uint8_t* words, uint32_t* msg_index, uint32_t* unix_ts);
+void decode_packets(uint64_t* packets, const uint64_t n, uint8_t* packet_type,
+                    uint8_t* chipid, uint8_t* channelid, uint64_t* timestamp,
+                    uint8_t* first_packet, uint8_t* dataword, uint8_t* trigger_type,
+                    uint8_t* local_fifo, uint8_t* shared_fifo,
+                    uint8_t* downstream_marker, uint8_t* parity);
+
 #endif
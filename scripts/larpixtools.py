@@ -8,27 +8,53 @@ import struct
 #-----------------------------------------------------------------------------
 #Key
 class Key(object):
+    '''
+    Chip key (io_group, io_channel, chip_id). Keys are immutable and interned,
+    constructing an equal key returns the existing object. ``packed`` is the
+    integer form used by the array helpers (see pack_chip_keys).
+
+    '''
     key_delimiter = '-'
     key_format = key_delimiter.join(('{io_group}', '{io_channel}', '{chip_id}'))
 
-    def __init__(self, *args):
-        self._initialized = False
+    _interned = dict()
+
+    def __new__(cls, *args):
+        if len(args) == 1 and isinstance(args[0], Key):
+            return args[0]
         if len(args) == 3:
-            self.io_group = args[0]
-            self.io_channel = args[1]
-            self.chip_id = args[2]
+            try:
+                return cls._interned[(args[0], args[1], args[2])]
+            except (KeyError, TypeError):
+                pass
+        key = super(Key, cls).__new__(cls)
+        key._initialized = False
+        if len(args) == 3:
+            key.io_group = args[0]
+            key.io_channel = args[1]
+            key.chip_id = args[2]
         elif len(args) == 1:
-            if isinstance(args[0], Key):
-                self.io_group = args[0].io_group
-                self.io_channel = args[0].io_channel
-                self.chip_id = args[0].chip_id
-            elif isinstance(args[0], bytes):
-                self.keystring = str(args[0].decode("utf-8"))
+            if isinstance(args[0], bytes):
+                key.keystring = str(args[0].decode("utf-8"))
             else:
-                self.keystring = str(args[0])
+                key.keystring = str(args[0])
         else:
             raise TypeError('Key() takes 1 or 3 arguments ({} given)'.format(len(args)))
-        self._initialized = True
+        ids = (key.io_group, key.io_channel, key.chip_id)
+        if ids in cls._interned:
+            return cls._interned[ids]
+        key._keystring = key.keystring
+        key._hash = hash(key._keystring)
+        key._initialized = True
+        cls._interned[ids] = key
+        return key
+
+    def __init__(self, *args):
+        # all set up (or looked up) in __new__
+        pass
+
+    def __reduce__(self):
+        return (Key, (self.io_group, self.io_channel, self.chip_id))
 
     def __repr__(self):
         return 'Key(\'{}\')'.format(self.keystring)
@@ -37,6 +63,8 @@ class Key(object):
         return self.keystring
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, Key):
             return self.io_group == other.io_group and \
             self.io_channel == other.io_channel \
@@ -52,13 +80,24 @@ class Key(object):
         return not self == other
 
     def __hash__(self):
-        return hash(str(self))
+        return self._hash
 
     def __getitem__(self, index):
         return (self.io_group, self.io_channel, self.chip_id)[index]
 
+    @property
+    def packed(self):
+        return (self.io_group << 16) | (self.io_channel << 8) | self.chip_id
+
+    @staticmethod
+    def from_packed(value):
+        value = int(value)
+        return Key((value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+
     @property
     def keystring(self):
+        if self._initialized:
+            return self._keystring
         return Key.key_format.format(
                 io_group = self.io_group,
                 io_channel = self.io_channel,
@@ -163,12 +202,6 @@ def touint(bits, endian='big'):
     return int(bin_string[::-1], 2)
 
 #PacketV2
-def _clears_cached_int(func):
-    def new_func(self, *args, **kwargs):
-        self._int = None
-        return func(self, *args, **kwargs)
-    return new_func
-
 def _clears_cached_chip_key(func):
     def new_func(self, *args, **kwargs):
         if hasattr(self, '_chip_key'):
@@ -177,7 +210,21 @@ def _clears_cached_chip_key(func):
     return new_func
 
 class Packet_v2(object):
+    '''
+    LArPix v2 packet. The 64-bit word is held as a single python int (bit 0 is
+    the first bit on the wire), all fields are read and written by shift/mask.
+    The optional per-packet attributes (``direction``, ``receipt_timestamp``,
+    ``valid_parity``) live in ``__slots__`` and are unset until assigned.
+    ``fifo_diagnostics_enabled`` is a class attribute, so it can be switched
+    for all packets at once; assigning it on a packet overrides it for that
+    packet only (the instance ``__dict__`` is only created when this happens).
+
+    '''
+    __slots__ = ('_int', '_io_group', '_io_channel', '_chip_key',
+                 'direction', 'receipt_timestamp', 'valid_parity', '__dict__')
+
     asic_version = 2
+    fifo_diagnostics_enabled = False
     size = 64
     num_bytes = 8
 
@@ -205,8 +252,6 @@ class Packet_v2(object):
     register_address_bits = slice(10,18)
     register_data_bits = slice(18,26)
 
-    fifo_diagnostics_enabled = False
-
     DATA_PACKET = 0
     TEST_PACKET = 1
     CONFIG_WRITE_PACKET = 2
@@ -220,20 +265,18 @@ class Packet_v2(object):
     endian = 'little'
 
     def __init__(self, bytestream=None):
-        self._int = None
+        self._io_group = None
+        self._io_channel = None
         if bytestream is None:
-            self.bits = bitarray(self.size,endian=self.endian)
-            self.bits.setall(False)
-            return
+            self._int = 0
         elif len(bytestream) == self.num_bytes:
-            self.bits = bitarray(endian=self.endian)
-            self.bits.frombytes(bytestream)
+            self._int = int.from_bytes(bytestream, self.endian)
         else:
             raise ValueError('Invalid number of bytes: %s' %
                     len(bytestream))
 
     def __eq__(self, other):
-        return self.bits == other.bits
+        return self._int == other.as_int()
 
     def __ne__(self, other):
         return not (self == other)
@@ -295,7 +338,22 @@ class Packet_v2(object):
         return 'Packet_v2(' + str(self.bytes()) + ')'
 
     def bytes(self):
-        return self.bits.tobytes() #[::-1]
+        return self._int.to_bytes(self.num_bytes, self.endian)
+
+    @property
+    def bits(self):
+        '''
+        The packet word as a (little endian) ``bitarray``. This is a copy,
+        modifying it does not change the packet - assign it back instead.
+
+        '''
+        bits = bitarray(endian=self.endian)
+        bits.frombytes(self.bytes())
+        return bits
+
+    @bits.setter
+    def bits(self, value):
+        self._int = touint(bitarray(value), endian=self.endian)
 
     def export(self):
         type_map = {
@@ -348,29 +406,30 @@ class Packet_v2(object):
         if 'local_fifo_events' in d or 'shared_fifo_events' in d:
             self.fifo_diagnostics_enabled = True
         for key, value in d.items():
-            if key in ('type_str', 'valid_parity'):
+            if key in ('asic_version', 'type_str', 'valid_parity'):
                 continue
-            elif key == 'bits':
-                self.bits = bitarray(value)
-            else:
-                setattr(self, key, value)
+            setattr(self, key, value)
 
     def as_int(self):
-        if self._int is None:
-            self._int = touint(self.bits, endian=self.endian)
         return self._int
 
+    def _get_bits(self, bit_slice):
+        return (self._int >> bit_slice.start) & ((1 << (bit_slice.stop - bit_slice.start)) - 1)
+
+    def _set_bits(self, bit_slice, value):
+        mask = ((1 << (bit_slice.stop - bit_slice.start)) - 1) << bit_slice.start
+        self._int = (self._int & ~mask) | ((int(value) << bit_slice.start) & mask)
+
     @property
     def chip_key(self):
         if hasattr(self, '_chip_key'):
             return self._chip_key
-        if self.io_group is None or self.io_channel is None:
+        if self._io_group is None or self._io_channel is None:
             return None
-        self._chip_key = Key(self.io_group, self.io_channel, self.chip_id)
+        self._chip_key = Key(self._io_group, self._io_channel, self.chip_id)
         return self._chip_key
 
     @chip_key.setter
-    @_clears_cached_int
     @_clears_cached_chip_key
     def chip_key(self, value):
         if value is None:
@@ -386,54 +445,40 @@ class Packet_v2(object):
 
     @property
     def io_group(self):
-        if hasattr(self, '_io_group'):
-            return self._io_group
-        return None
+        return self._io_group
 
     @io_group.setter
     @_clears_cached_chip_key
     def io_group(self, value):
-        if value is None:
-            if hasattr(self, '_io_group'):
-                del self._io_group
-            return
         self._io_group = value
 
     @property
     def io_channel(self):
-        if hasattr(self, '_io_channel'):
-            return self._io_channel
-        return None
+        return self._io_channel
 
     @io_channel.setter
     @_clears_cached_chip_key
     def io_channel(self, value):
-        if value is None:
-            if hasattr(self, '_io_channel'):
-                del self._io_channel
-            return
         self._io_channel = value
 
     @property
     def timestamp(self):
         if self.fifo_diagnostics_enabled:
-            return touint(self.bits[self.fifo_diagnostics_timestamp_bits], endian=self.endian)
-        return touint(self.bits[self.timestamp_bits], endian=self.endian)
+            return self._get_bits(self.fifo_diagnostics_timestamp_bits)
+        return self._get_bits(self.timestamp_bits)
 
     @timestamp.setter
-    @_clears_cached_int
     def timestamp(self, value):
         if self.fifo_diagnostics_enabled:
-            self.bits[self.fifo_diagnostics_timestamp_bits] = fromuint(value, self.fifo_diagnostics_timestamp_bits, endian=self.endian)
+            self._set_bits(self.fifo_diagnostics_timestamp_bits, value)
         else:
-            self.bits[self.timestamp_bits] = fromuint(value, self.timestamp_bits, endian=self.endian)
+            self._set_bits(self.timestamp_bits, value)
 
     @property
     def local_fifo_half(self):
         return self.local_fifo%2
 
     @local_fifo_half.setter
-    @_clears_cached_int
     def local_fifo_half(self, value):
         self.local_fifo = self.local_fifo_full*2 + value
 
@@ -442,7 +487,6 @@ class Packet_v2(object):
         return self.local_fifo//2
 
     @local_fifo_full.setter
-    @_clears_cached_int
     def local_fifo_full(self, value):
         self.local_fifo = value*2 + self.local_fifo_half
 
@@ -451,7 +495,6 @@ class Packet_v2(object):
         return self.shared_fifo%2
 
     @shared_fifo_half.setter
-    @_clears_cached_int
     def shared_fifo_half(self, value):
         self.shared_fifo = self.shared_fifo_full*2 + value
 
@@ -460,14 +503,12 @@ class Packet_v2(object):
         return self.shared_fifo//2
 
     @shared_fifo_full.setter
-    @_clears_cached_int
     def shared_fifo_full(self, value):
         self.shared_fifo = value*2 + self.shared_fifo_half
 
     def compute_parity(self):
-        return 1 - (self.bits[self.parity_calc_bits].count(True) % 2)
+        return 1 - (bin(self._get_bits(self.parity_calc_bits)).count('1') % 2)
 
-    @_clears_cached_int
     def assign_parity(self):
         self.parity = self.compute_parity()
 
@@ -477,57 +518,50 @@ class Packet_v2(object):
     @property
     def local_fifo_events(self):
         if self.fifo_diagnostics_enabled:
-            bit_slice = self.local_fifo_events_bits
-            return touint(self.bits[bit_slice], endian=self.endian)
+            return self._get_bits(self.local_fifo_events_bits)
         return None
 
     @local_fifo_events.setter
-    @_clears_cached_int
     def local_fifo_events(self, value):
         if self.fifo_diagnostics_enabled:
-            bit_slice = self.local_fifo_events_bits
-            self.bits[bit_slice] = fromuint(value, bit_slice, endian=self.endian)
+            self._set_bits(self.local_fifo_events_bits, value)
 
     @property
     def shared_fifo_events(self):
         if self.fifo_diagnostics_enabled:
-            bit_slice = self.shared_fifo_events_bits
-            return touint(self.bits[bit_slice], endian=self.endian)
+            return self._get_bits(self.shared_fifo_events_bits)
         return None
 
     @shared_fifo_events.setter
-    @_clears_cached_int
     def shared_fifo_events(self, value):
         if self.fifo_diagnostics_enabled:
-            bit_slice = self.shared_fifo_events_bits
-            self.bits[bit_slice] = fromuint(value, bit_slice, endian=self.endian)
+            self._set_bits(self.shared_fifo_events_bits, value)
 
     @property
     def chip_id(self):
-        bit_slice = self.chip_id_bits
-        return touint(self.bits[bit_slice], endian=self.endian)
+        return self._get_bits(self.chip_id_bits)
 
     @chip_id.setter
-    @_clears_cached_int
     @_clears_cached_chip_key
     def chip_id(self, value):
-        bit_slice = self.chip_id_bits
-        self.bits[bit_slice] = fromuint(value, bit_slice, endian=self.endian)
+        self._set_bits(self.chip_id_bits, value)
 
     @classmethod
     def _basic_getter(cls, name):
         bit_slice = getattr(cls, name + '_bits')
-        mask = (~(((2**cls.size)-1 << (bit_slice.stop-bit_slice.start))) & (2**cls.size)-1)
+        shift = bit_slice.start
+        mask = (1 << (bit_slice.stop - bit_slice.start)) - 1
         def basic_getter_func(self):
-            return (self.as_int() >> bit_slice.start) & mask
+            return (self._int >> shift) & mask
         return basic_getter_func
 
     @classmethod
     def _basic_setter(cls, name):
         bit_slice = getattr(cls, name + '_bits')
-        @_clears_cached_int
+        shift = bit_slice.start
+        mask = ((1 << (bit_slice.stop - bit_slice.start)) - 1) << shift
         def basic_setter_func(self, value):
-            self.bits[bit_slice] = fromuint(value, bit_slice, endian=self.endian)
+            self._int = (self._int & ~mask) | ((int(value) << shift) & mask)
         return basic_setter_func
 
 Packet_v2.packet_type = property(Packet_v2._basic_getter('packet_type'),Packet_v2._basic_setter('packet_type'))
@@ -608,7 +642,7 @@ class TriggerPacket(object):
         self.io_group = key.io_group
 
 # Sync packet
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 class SyncPacket(object):
     packet_type = 6
     
@@ -1542,6 +1576,24 @@ def _format_configs_chip_v2_4(chip, version='2.4', dset='configs', timestamp=0,
         row['registers'][0,i] = touint(bits, endian=endian)
     return row
 
+_format_method_lookup = {
+    '2.0': {
+        'packets': _format_packets_packet_v2_0
+    },
+    '2.1': {
+        'packets': _format_packets_packet_v2_1
+    },
+    '2.2': {
+        'packets': _format_packets_packet_v2_2
+    },
+    '2.3': {
+        'packets': _format_packets_packet_v2_3
+    },
+    '2.4': {
+        'packets': _format_packets_packet_v2_3
+    }
+}
+
 _parse_method_lookup = {
     '0.0': {
         'raw_packet': _parse_raw_packet_v0_0
@@ -1566,65 +1618,114 @@ _parse_method_lookup = {
     }
 }
 
-def from_file(filename, version=None, start=None, end=None, load_configs=None):
-    with h5py.File(filename, 'r') as f:
-        file_version = f['_header'].attrs['version']
-        if version is None:
-            version = file_version
-        elif version[0] == '~':
-            file_major, _, file_minor = file_version.split('.')
-            version_major, _, version_minor = version.split('.')
-            version_major = version_major[1:]
-            if (file_major != version_major
-                    or file_minor < version_minor):
-                raise RuntimeError('Incompatible versions: existing: %s, '
-                    'specified: %s' % (file_version, version))
-            else:
-                version = file_version
-        elif version == file_version:
-            pass
-        else:
+def _resolve_version(file_version, version=None):
+    if version is None:
+        version = file_version
+    elif version[0] == '~':
+        file_major, _, file_minor = file_version.partition('.')
+        version_major, _, version_minor = version.partition('.')
+        version_major = version_major[1:]
+        if (file_major != version_major
+                or file_minor < version_minor):
             raise RuntimeError('Incompatible versions: existing: %s, '
                 'specified: %s' % (file_version, version))
+        else:
+            version = file_version
+    elif version == file_version:
+        pass
+    else:
+        raise RuntimeError('Incompatible versions: existing: %s, '
+            'specified: %s' % (file_version, version))
+
+    if version not in dtypes:
+        raise RuntimeError('Unknown version: %s' % version)
+    return version
+
+_from_file_chunk_rows = 65536
+
+class _MessageCache(object):
+    # Read-through cache of the ``messages`` dataset for the packet parsers,
+    # which look up the row of each message packet. Nothing is read up front,
+    # rows are read chunk by chunk as they are looked up (or prefetched): only
+    # the max_chunks most recently used chunks are kept, the least recently
+    # used one is evicted (and read again on its next lookup) when another
+    # chunk is loaded.
+    def __init__(self, dset, chunk_rows=65536, max_chunks=16):
+        self.dset = dset
+        self.chunk_rows = chunk_rows
+        self.max_chunks = max_chunks
+        self._chunks = OrderedDict()
+
+    def __len__(self):
+        return len(self.dset)
+
+    def _chunk(self, i_chunk):
+        if i_chunk in self._chunks:
+            self._chunks.move_to_end(i_chunk)
+        else:
+            start = i_chunk * self.chunk_rows
+            self._chunks[i_chunk] = self.dset[start:start + self.chunk_rows]
+            if len(self._chunks) > self.max_chunks:
+                self._chunks.popitem(last=False)
+        return self._chunks[i_chunk]
+
+    def prefetch(self, indices):
+        # loads the chunks holding ``indices`` in one pass, of more than
+        # max_chunks chunks only the last max_chunks stay cached
+        for i_chunk in np.unique(np.asarray(indices, dtype=np.int64) // self.chunk_rows)[-self.max_chunks:]:
+            self._chunk(int(i_chunk))
 
-        if version not in dtypes:
-            raise RuntimeError('Unknown version: %s' % version)
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = int(index)
+            if index < 0:
+                index += len(self.dset)
+            if not 0 <= index < len(self.dset):
+                raise IndexError('message index {} out of range'.format(index))
+            return self._chunk(index // self.chunk_rows)[index % self.chunk_rows]
+        return self.dset[index]
+
+def from_file(filename, version=None, start=None, end=None, load_configs=None,
+        fields=None):
+    # With ``fields`` given 'packets' is a structured array holding only those
+    # compound members, read straight from the file without building packet
+    # objects
+    with h5py.File(filename, 'r') as f:
+        version = _resolve_version(f['_header'].attrs['version'], version)
 
         if version == '0.0':
             dset_name = 'raw_packet'
-            message_dset = None
             configs_dset = None
         else:
             dset_name = 'packets'
             message_dset_name = 'messages'
             message_props = (
                     dtype_property_index_lookup[version][message_dset_name])
-            message_dset = f[message_dset_name]
 
         props = dtype_property_index_lookup[version][dset_name]
-        packets = []
-        if start is None and end is None:
-            dset_iter = f[dset_name]
+        if fields is not None:
+            packets = f[dset_name].fields(list(fields))[start:end]
         else:
-            dset_iter = f[dset_name][start:end]
-        for row in dset_iter:
-            pkt = _parse_method_lookup[version][dset_name](row, message_dset)
-            if pkt is not None:
-                packets.append(pkt)
-
-        configs = []
-        if version >= '2.4':
-            dset_name ='configs'
-            if load_configs:
-                if isinstance(load_configs,bool):
-                    dset_iter = f[dset_name]
-                else:
-                    dset_iter = f[dset_name][load_configs]
-                asic_version = f[dset_name].attrs['asic_version']
-                for row in dset_iter:
-                    chip = _parse_method_lookup[version][dset_name](row, asic_version=asic_version)
-                    if chip is not None:
-                        configs.append(chip)
+            packets = []
+            dset = f[dset_name]
+            # message packets look their message up in the messages dataset
+            message_dset = None if version == '0.0' else _MessageCache(f[message_dset_name])
+            start, end, _ = slice(start, end).indices(len(dset))
+            type_name = 'type' if 'type' in dset.dtype.names else 'packet_type'
+            for chunk_start in range(start, end, _from_file_chunk_rows):
+                rows = dset[chunk_start:min(chunk_start + _from_file_chunk_rows, end)]
+                if message_dset is not None:
+                    message_dset.prefetch(rows['counter'][rows[type_name] == 5])
+                for row in rows:
+                    pkt = _parse_method_lookup[version][dset_name](row, message_dset)
+                    if pkt is not None:
+                        packets.append(pkt)
+
+        # no chip objects here, configs are read into the read_configs dict
+        # of arrays, which is left empty unless load_configs is set
+        configs = dict()
+        if version >= '2.4' and load_configs:
+            configs = _read_configs(f, None if isinstance(load_configs, bool) else load_configs)
         return {
                 'packets': packets,
                 'configs': configs,
@@ -1633,6 +1734,345 @@ def from_file(filename, version=None, start=None, end=None, load_configs=None):
                 'version': f['_header'].attrs['version'],
                 }
 
+def iter_file(filename, chunk_rows=65536, fields=None, dset_name=None,
+        version=None, start=None, end=None):
+    # Yields rows of ``dset_name`` (defaults to the packets dataset) as
+    # structured arrays of at most chunk_rows rows, so that memory use does
+    # not depend on the file size. ``fields`` restricts the read to the given
+    # compound members.
+    with h5py.File(filename, 'r') as f:
+        version = _resolve_version(f['_header'].attrs['version'], version)
+        if dset_name is None:
+            dset_name = 'raw_packet' if version == '0.0' else 'packets'
+        if dset_name not in dtypes[version]:
+            raise RuntimeError('Unknown dataset for version %s: %s' % (version, dset_name))
+        if dset_name not in f:
+            return
+
+        dset = f[dset_name]
+        start, end, _ = slice(start, end).indices(len(dset))
+        if fields is not None:
+            dset = dset.fields(list(fields))
+        for chunk_start in range(start, end, chunk_rows):
+            yield dset[chunk_start:min(chunk_start + chunk_rows, end)]
+
+def _read_configs(f, selection=None):
+    dset = f['configs']
+    rows = dset[()] if selection is None else dset[selection]
+    rows = np.atleast_1d(rows)
+    configs = dict((name, rows[name]) for name in ('io_group', 'io_channel', 'chip_id', 'timestamp'))
+    configs['registers'] = rows['registers'].reshape(len(rows), -1)
+    configs['asic_version'] = dset.attrs.get('asic_version', Packet_v2.asic_version)
+    return configs
+
+def read_configs(filename, selection=None):
+    # Reads the ``configs`` rows of a 2.4 file (all, or the rows of a slice or
+    # index array) into a dict of arrays: the (N, 239) ``registers`` matrix,
+    # the io_group/io_channel/chip_id/timestamp columns and the asic_version
+    with h5py.File(filename, 'r') as f:
+        version = _resolve_version(f['_header'].attrs['version'])
+        if 'configs' not in dtypes[version]:
+            raise RuntimeError('No configs dataset in version %s' % version)
+        return _read_configs(f, selection)
+
+def config_index(configs):
+    # Index of read_configs output for latest_configs: the configs ordered by
+    # chip key and time, with the time as its rank among the distinct config
+    # timestamps, packed into one sortable uint64 per config
+    keys = pack_chip_keys(configs['io_group'], configs['io_channel'], configs['chip_id'])
+    times, time_rank = np.unique(configs['timestamp'], return_inverse=True)
+    packed = (keys.astype(np.uint64) << np.uint64(32)) | time_rank.ravel().astype(np.uint64)
+    order = np.argsort(packed, kind='stable')
+    return dict(packed=packed[order], order=order, times=times, keys=np.unique(keys))
+
+def latest_configs(index, t, keys=None):
+    # Row (into the read_configs arrays) of the last config of each chip with
+    # timestamp <= t, -1 for chips without one. keys are packed chip keys or
+    # Key objects (default: every chip in the index) and t a time or one per
+    # key. Returns the packed keys and the rows.
+    if keys is None:
+        keys = index['keys']
+    else:
+        keys = np.array([key.packed if isinstance(key, Key) else key for key in keys],
+            dtype=chip_key_dtype)
+    time_rank = np.searchsorted(index['times'], t, side='right')
+    query = (keys.astype(np.uint64) << np.uint64(32)) | np.asarray(time_rank, dtype=np.uint64)
+    last = np.searchsorted(index['packed'], query, side='left') - 1
+    found = last >= 0
+    found[found] = (index['packed'][last[found]] >> np.uint64(32)) == keys.astype(np.uint64)[found]
+    rows = np.where(found, index['order'][np.maximum(last, 0)], -1)
+    return keys, rows
+
+
+import threading
+import queue
+
+_packet_types_attr = '''
+0: 'data',
+1: 'test',
+2: 'config write',
+3: 'config read',
+4: 'timestamp',
+5: 'message',
+6: 'sync',
+7: 'trigger',
+'''
+
+class PacketFileWriter(object):
+    '''
+    Appends packets to a larpix HDF5 file in the 2.x layout. Rows are
+    collected in preallocated buffers of ``buffer_rows`` rows, full buffers are
+    written out to the resizable, chunked ``packets`` dataset by a background
+    thread so that ``append`` only has to copy rows. ``messages`` and
+    ``configs`` rows go through the same thread, unbuffered.
+
+    ``append`` takes ``packets`` rows (e.g. from decode_packets_v2 or
+    msg_to_packets) or an iterable of packet objects. Errors from the writer
+    thread are raised by the next append/flush/close.
+
+    Usage::
+
+        with PacketFileWriter('out.h5', compression='gzip') as writer:
+            writer.append(packets)
+
+    '''
+    def __init__(self, filename, version='2.4', mode='a', chunk_rows=65536,
+            buffer_rows=None, n_buffers=4, compression=None, compression_opts=None):
+        if version not in _format_method_lookup:
+            raise RuntimeError('Unsupported version: %s' % version)
+        self.version = version
+        self.packet_dtype = np.dtype(dtypes[version]['packets'])
+        self._file = h5py.File(filename, mode)
+        if '_header' in self._file:
+            _resolve_version(self._file['_header'].attrs['version'], version)
+        else:
+            header = self._file.create_group('_header')
+            header.attrs['version'] = version
+            header.attrs['created'] = time.time()
+            header.attrs['modified'] = time.time()
+        for dset_name in dtypes[version]:
+            if dset_name in self._file:
+                continue
+            dset = self._file.create_dataset(dset_name, shape=(0,),
+                maxshape=(None,), dtype=dtypes[version][dset_name],
+                chunks=(chunk_rows,) if dset_name == 'packets' else True,
+                compression=compression, compression_opts=compression_opts)
+            if dset_name == 'packets':
+                dset.attrs['packet_types'] = _packet_types_attr
+            elif dset_name == 'configs':
+                dset.attrs['asic_version'] = Packet_v2.asic_version
+        self._n_messages = len(self._file['messages'])
+
+        buffer_rows = chunk_rows if buffer_rows is None else buffer_rows
+        self._free = queue.Queue()
+        for _ in range(max(n_buffers, 2) - 1):
+            self._free.put(np.zeros(buffer_rows, dtype=self.packet_dtype))
+        self._buffer = np.zeros(buffer_rows, dtype=self.packet_dtype)
+        self._n_buffered = 0
+        self._pending = queue.Queue()
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            try:
+                if item is None:
+                    return
+                dset_name, rows, n_rows, recycle = item
+                if self._error is None:
+                    dset = self._file[dset_name]
+                    n = len(dset)
+                    dset.resize((n + n_rows,))
+                    dset[n:n + n_rows] = rows[:n_rows]
+            except Exception as e:
+                self._error = e
+            finally:
+                if item is not None and recycle:
+                    self._free.put(rows)
+                self._pending.task_done()
+
+    def _check(self):
+        if self._closed:
+            raise RuntimeError('PacketFileWriter is closed')
+        if self._error is not None:
+            raise self._error
+
+    def _hand_off(self):
+        if self._n_buffered:
+            self._pending.put(('packets', self._buffer, self._n_buffered, True))
+            self._buffer = self._free.get() # blocks while all buffers are in flight
+            self._n_buffered = 0
+
+    def _encode(self, packets):
+        # packet objects to ``packets`` rows, message packets also get their
+        # ``messages`` row
+        rows = np.zeros(len(packets), dtype=self.packet_dtype)
+        messages = []
+        format_packet = _format_method_lookup[self.version]['packets']
+        for i, pkt in enumerate(packets):
+            rows[i] = tuple(format_packet(pkt, version=self.version))
+            if isinstance(pkt, MessagePacket):
+                rows[i]['counter'] = self._n_messages + len(messages)
+                messages.append(_format_messages_message_packet_v1_0(pkt,
+                    counter=self._n_messages + len(messages)))
+        if messages:
+            self.append_messages(messages)
+        return rows
+
+    def append(self, packets):
+        self._check()
+        if not isinstance(packets, np.ndarray):
+            packets = self._encode(list(packets))
+        elif packets.dtype != self.packet_dtype:
+            rows = np.zeros(len(packets), dtype=self.packet_dtype)
+            for name in packets.dtype.names:
+                if name in self.packet_dtype.names:
+                    rows[name] = packets[name]
+            packets = rows
+        i = 0
+        while i < len(packets):
+            n = min(len(packets) - i, len(self._buffer) - self._n_buffered)
+            self._buffer[self._n_buffered:self._n_buffered + n] = packets[i:i + n]
+            self._n_buffered += n
+            i += n
+            if self._n_buffered == len(self._buffer):
+                self._hand_off()
+
+    def append_messages(self, messages):
+        # (message, timestamp, index) tuples or ``messages`` rows
+        self._check()
+        rows = np.array(messages, dtype=dtypes[self.version]['messages'])
+        self._n_messages += len(rows)
+        self._pending.put(('messages', rows, len(rows), False))
+
+    def append_configs(self, configs, timestamp=0):
+        # ``configs`` rows or chip objects (see _format_configs_chip_v2_4)
+        self._check()
+        if 'configs' not in dtypes[self.version]:
+            raise RuntimeError('No configs dataset in version %s' % self.version)
+        if not isinstance(configs, np.ndarray):
+            configs = np.concatenate([_format_configs_chip_v2_4(chip,
+                version=self.version, timestamp=timestamp) for chip in configs])
+        self._pending.put(('configs', configs, len(configs), False))
+
+    def flush(self):
+        # writes out everything appended so far
+        self._check()
+        self._hand_off()
+        self._pending.join()
+        self._check()
+        self._file['_header'].attrs['modified'] = time.time()
+        self._file.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._pending.put(None)
+            self._thread.join()
+            self._file.close()
+
+
+import concurrent.futures
+from multiprocessing import resource_tracker, shared_memory
+
+def _decode_file_range(filename, start, end, fields=None, version=None, reducer=None):
+    # decode_files worker: reads rows [start, end) of the packets dataset,
+    # applies the reducer and hands the resulting array back through a shared
+    # memory block (name, dtype, length) that the caller unlinks
+    blocks = list(iter_file(filename, chunk_rows=max(end - start, 1),
+        fields=fields, version=version, start=start, end=end))
+    rows = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+    if reducer is not None:
+        rows = np.asarray(reducer(rows))
+    if rows.nbytes == 0:
+        return None, rows.dtype, 0
+    shm = shared_memory.SharedMemory(create=True, size=rows.nbytes)
+    np.ndarray(rows.shape, dtype=rows.dtype, buffer=shm.buf)[:] = rows
+    shm.close()
+    return shm.name, rows.dtype, len(rows)
+
+def _collect_block(name, dtype, n_rows, out):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        out[:] = np.ndarray((n_rows,), dtype=dtype, buffer=shm.buf)
+    finally:
+        shm.close()
+        shm.unlink()
+
+def decode_files(filenames, workers=None, reducer=None, fields=None,
+        rows_per_task=1<<20, version=None, order=None):
+    # Reads the packets of many files in a process pool. Files are split into
+    # tasks of at most rows_per_task rows, each worker returns its rows (with
+    # ``fields`` projection and ``reducer`` applied, the reducer must be a
+    # picklable function taking and returning a structured array) through
+    # shared memory. The blocks are concatenated in file order and, if
+    # ``order`` names a field, stable sorted by it. The raw ``timestamp``
+    # field mixes clocks (unix seconds in timestamp packets, rolling ticks
+    # elsewhere), to order in time sort on unwrap_timestamps instead.
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    tasks = []
+    for filename in filenames:
+        with h5py.File(filename, 'r') as f:
+            file_version = _resolve_version(f['_header'].attrs['version'], version)
+            dset_name = 'raw_packet' if file_version == '0.0' else 'packets'
+            n_rows = len(f[dset_name]) if dset_name in f else 0
+        for start in range(0, n_rows, rows_per_task):
+            tasks.append((filename, start, min(start + rows_per_task, n_rows)))
+    if not tasks:
+        return np.zeros(0, dtype=dtypes['2.4']['packets'])
+
+    blocks = []
+    error = None
+    # workers must share our resource tracker, otherwise their blocks are
+    # unlinked when they exit
+    resource_tracker.ensure_running()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_decode_file_range, filename, start, end,
+                fields, version, reducer) for filename, start, end in tasks]
+            for future in futures:
+                # keep collecting after a failure so no block is leaked
+                try:
+                    blocks.append(future.result())
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            raise error
+        dtypes_found = set(dtype for _, dtype, _ in blocks)
+        if len(dtypes_found) != 1:
+            raise RuntimeError('Files do not share one row format: %s' % dtypes_found)
+        packets = np.empty(sum(n_rows for _, _, n_rows in blocks), dtype=blocks[0][1])
+        i = 0
+        while blocks:
+            name, dtype, n_rows = blocks.pop(0)
+            if n_rows:
+                _collect_block(name, dtype, n_rows, packets[i:i + n_rows])
+            i += n_rows
+    finally:
+        for name, _, n_rows in blocks:
+            if n_rows:
+                shm = shared_memory.SharedMemory(name=name)
+                shm.close()
+                shm.unlink()
+
+    if order is not None and packets.dtype.names and order in packets.dtype.names:
+        packets = packets[np.argsort(packets[order], kind='stable')]
+    return packets
+
 
 #-----------------------------------------------------------------------------
 # Pacman format section
@@ -1727,10 +2167,8 @@ def parse_word(msg_type, word):
     return (word_type,) + tuple(word_struct_table[word_type].unpack(word)[1:])
 
 def format_msg(msg_type, msg_words):
-    bytestream = format_header(msg_type, len(msg_words))
-    for msg_word in msg_words:
-        bytestream += format_word(msg_type, *msg_word)
-    return bytestream
+    return format_header(msg_type, len(msg_words)) + b''.join([
+        format_word(msg_type, *msg_word) for msg_word in msg_words])
 
 def parse_msg(msg):
     header = parse_header(msg)
@@ -1804,6 +2242,878 @@ def parse(msg, io_group=None):
     return packets
 
 
+#-----------------------------------------------------------------------------
+# Array format section
+#-----------------------------------------------------------------------------
+
+_packet_word_dtype = np.dtype('<u8')
+
+def _as_packet_words(buf):
+    if isinstance(buf, np.ndarray) and buf.dtype != np.uint8:
+        return np.ascontiguousarray(buf, dtype=_packet_word_dtype).ravel()
+    return np.frombuffer(buf, dtype=_packet_word_dtype)
+
+def _get_bits(words, bit_slice):
+    mask = np.uint64((1 << (bit_slice.stop - bit_slice.start)) - 1)
+    return (words >> np.uint64(bit_slice.start)) & mask
+
+def _parity_fold(words, n_bits):
+    # odd parity of the low n_bits, xor-folded down to bit 0
+    folded = words & np.uint64((1 << n_bits) - 1)
+    for shift in (32, 16, 8, 4, 2, 1):
+        folded = folded ^ (folded >> np.uint64(shift))
+    return (np.uint64(1) - (folded & np.uint64(1))).astype(np.uint8)
+
+def _parity_v2(words):
+    return _parity_fold(words, Packet_v2.parity_calc_bits.stop)
+
+# A v1 packet read as a little-endian int has Packet_v1.bits reversed: the
+# parity bit (bits[0]) is bit 53 and the parity-protected bits are 0-52
+_parity_v1_bit = Packet_v1.size - 1 - Packet_v1.parity_bit
+
+def _as_packet_words_v1(buf):
+    if isinstance(buf, np.ndarray) and buf.dtype != np.uint8:
+        return np.ascontiguousarray(buf, dtype=_packet_word_dtype).ravel()
+    packet_bytes = np.frombuffer(buf, dtype=np.uint8).reshape(-1, Packet_v1.num_bytes)
+    padded = np.zeros((len(packet_bytes), 8), dtype=np.uint8)
+    padded[:, :Packet_v1.num_bytes] = packet_bytes
+    return padded.view(_packet_word_dtype).ravel()
+
+def valid_parity(buf, asic_version=2):
+    # Bulk has_valid_parity: True for each packet of buf (packet bytes back to
+    # back, or their words as a uint64 array) with a correct parity bit
+    if asic_version == 1:
+        words = _as_packet_words_v1(buf)
+        parity = _get_bits(words, slice(_parity_v1_bit, _parity_v1_bit + 1))
+        return parity == _parity_fold(words, _parity_v1_bit)
+    words = _as_packet_words(buf)
+    return _get_bits(words, Packet_v2.parity_bits) == _parity_v2(words)
+
+# Parity check of the LArPix (packet_type < 4) ``packets`` rows of a 2.x file
+# on their words rebuilt by encode_packets_v2. Returns the valid mask over all
+# rows (True for other packet types) and a dict of Key to the number of bad
+# parity packets of each chip that has any.
+def check_parity(packets):
+    rows = np.flatnonzero(packets['packet_type'] < 4)
+    valid = np.ones(len(packets), dtype=bool)
+    valid[rows] = valid_parity(encode_packets_v2(packets[rows]))
+    keys, counts = np.unique(packet_chip_keys(packets[~valid]), return_counts=True)
+    return valid, dict((Key.from_packed(key), int(count))
+        for key, count in zip(keys, counts))
+
+# Decodes 64-bit LArPix v2 words (bytes or a uint64 array) into the same
+# ``packets`` rows that _format_packets_packet_v2_3 produces per Packet_v2.
+# io_group/io_channel/receipt_timestamp are not in the word itself and may be
+# scalars or per-packet arrays.
+def decode_packets_v2(buf, io_group=0, io_channel=0, receipt_timestamp=0,
+        fifo_diagnostics_enabled=False, version='2.4'):
+    words = _as_packet_words(buf)
+    packets = np.zeros(len(words), dtype=dtypes[version]['packets'])
+    packets['io_group'] = io_group
+    packets['io_channel'] = io_channel
+    for name in ('packet_type', 'chip_id', 'downstream_marker', 'parity',
+            'channel_id', 'first_packet', 'dataword', 'trigger_type',
+            'local_fifo', 'shared_fifo', 'register_address', 'register_data'):
+        packets[name] = _get_bits(words, getattr(Packet_v2, name + '_bits'))
+    packets['valid_parity'] = valid_parity(words)
+    if fifo_diagnostics_enabled:
+        packets['timestamp'] = _get_bits(words, Packet_v2.fifo_diagnostics_timestamp_bits)
+        packets['local_fifo_events'] = _get_bits(words, Packet_v2.local_fifo_events_bits)
+        packets['shared_fifo_events'] = _get_bits(words, Packet_v2.shared_fifo_events_bits)
+        packets['fifo_diagnostics_enabled'] = 1
+    else:
+        packets['timestamp'] = _get_bits(words, Packet_v2.timestamp_bits)
+    if 'receipt_timestamp' in packets.dtype.names:
+        packets['receipt_timestamp'] = receipt_timestamp
+    return packets
+
+# Decodes the ``raw_packet`` rows of a 0.0 file or the ``packets`` rows of a
+# 1.0 file (Packet_v1, timestamp and message packets) into the ``packets``
+# rows decode_packets_v2 produces, setting the fields _parse_raw_packet_v0_0
+# and _parse_packets_v1_0 set per packet type. Rows of other types are dropped.
+def decode_packets_v1(rows, version='2.4'):
+    rows = rows[rows['type'] <= 5]
+    packets = np.zeros(len(rows), dtype=dtypes[version]['packets'])
+    packet_type = rows['type']
+    packets['packet_type'] = packet_type
+    larpix = packet_type < 4
+    packets['io_group'], packets['io_channel'], _ = unpack_chip_keys(parse_chip_keys(rows['chip_key']))
+    packets['chip_id'] = np.where(larpix, rows['chipid'], 0)
+    packets['parity'] = np.where(larpix, rows['parity'], 0)
+    packets['valid_parity'] = np.where(larpix, rows['valid_parity'], 0)
+    if 'direction' in rows.dtype.names:
+        packets['direction'] = np.where(larpix, rows['direction'], 0)
+
+    data = packet_type == 0
+    packets['channel_id'] = np.where(data, rows['channel'], 0)
+    packets['dataword'] = np.where(data, rows['adc_counts'], 0)
+    packets['local_fifo'] = np.where(data, 2 * rows['fifo_full'] + rows['fifo_half'], 0)
+    packets['timestamp'] = np.where(data | (packet_type >= 4), rows['timestamp'], 0)
+    packets['counter'] = np.where((packet_type == 1) | (packet_type == 5), rows['counter'], 0)
+
+    config = (packet_type == 2) | (packet_type == 3)
+    packets['register_address'] = np.where(config, rows['register'], 0)
+    packets['register_data'] = np.where(config, rows['value'], 0)
+    return packets
+
+# PACMAN header/word layouts matching msg_header_fmt and word_fmt_table, the
+# TRIG/SYNC fields overlay the DATA ones
+msg_header_dtype = np.dtype(dict(
+    names=['msg_type', 'unix_ts', 'words'],
+    formats=['S1', '<u4', '<u2'],
+    offsets=[0, 1, 6],
+    itemsize=HEADER_LEN))
+msg_word_dtype = np.dtype(dict(
+    names=['word_type', 'io_channel', 'receipt_timestamp', 'packet',
+        'trigger_type', 'sync_type', 'clk_source', 'timestamp'],
+    formats=['S1', 'u1', '<u4', '<u8', 'S1', 'S1', 'u1', '<u4'],
+    offsets=[0, 1, 2, 8, 1, 1, 2, 4],
+    itemsize=WORD_LEN))
+
+def _word_type_codes(msg_type, word_type):
+    word_type = np.asarray(word_type)
+    if word_type.dtype.kind != 'U':
+        return word_type.astype('S1')
+    codes = np.empty(word_type.shape, dtype='S1')
+    for name in np.unique(word_type):
+        codes[word_type == name] = word_type_table[msg_type][str(name)]
+    return codes
+
+def format_words(word_type, io_channel=0, receipt_timestamp=0, packet=0, msg_type='DATA'):
+    # Builds an array of DATA/TX words from per-word columns. word_type may be
+    # given by name ('DATA', 'TX', ...) or by its byte code, other word types
+    # can be filled in through their fields on the returned array.
+    word_type = _word_type_codes(msg_type, word_type)
+    n = max(word_type.size, np.size(io_channel), np.size(receipt_timestamp), np.size(packet))
+    words = np.zeros(n, dtype=msg_word_dtype)
+    words['word_type'] = word_type
+    words['io_channel'] = io_channel
+    words['receipt_timestamp'] = receipt_timestamp
+    words['packet'] = packet
+    return words
+
+def format_msgs_array(msg_type, words, word_offsets, unix_ts=None):
+    # Writes the messages made of words[word_offsets[i]:word_offsets[i+1]]
+    # back to back into a single buffer, with unix_ts (one value, or one per
+    # message) in the headers. Returns the buffer and the byte offset of each
+    # message in it (with the total length appended).
+    words = np.ascontiguousarray(words, dtype=msg_word_dtype)
+    word_offsets = np.asarray(word_offsets, dtype=np.int64)
+    n_msgs = len(word_offsets) - 1
+    msg_words = np.diff(word_offsets)
+    if unix_ts is None:
+        unix_ts = int(time.time())
+
+    # header i and its words are laid out as 8-byte slots, header i sits at
+    # slot i + 2*word_offsets[i] and word j of message m at slot m + 1 + 2*j
+    msg_offsets = HEADER_LEN * np.arange(n_msgs + 1) + WORD_LEN * (word_offsets - word_offsets[0])
+    arena = bytearray(int(msg_offsets[-1]))
+    slots = np.frombuffer(arena, dtype='<u8')
+
+    headers = np.zeros(n_msgs, dtype=msg_header_dtype)
+    headers['msg_type'] = msg_type_table[msg_type]
+    headers['unix_ts'] = unix_ts
+    headers['words'] = msg_words
+    slots[msg_offsets[:-1] // HEADER_LEN] = headers.view('<u8')
+
+    word_slots = 2 * np.arange(word_offsets[-1] - word_offsets[0]) + 1 \
+        + np.repeat(np.arange(n_msgs), msg_words)
+    word_data = words[word_offsets[0]:word_offsets[-1]].view('<u8').reshape(-1, 2)
+    slots[word_slots] = word_data[:, 0]
+    slots[word_slots + 1] = word_data[:, 1]
+    return arena, msg_offsets
+
+def format_msg_array(msg_type, words, unix_ts=None):
+    return format_msgs_array(msg_type, words, [0, len(words)], unix_ts=unix_ts)[0]
+
+def parse_msg_array(msg):
+    # Zero-copy counterpart of parse_msg, returns views of the header and of
+    # the msg_word_dtype words in the message buffer
+    header = np.frombuffer(msg, dtype=msg_header_dtype, count=1)[0]
+    words = np.frombuffer(msg, dtype=msg_word_dtype,
+        count=(len(msg) - HEADER_LEN) // WORD_LEN, offset=HEADER_LEN)
+    return header, words
+
+# Array counterpart of parse for DATA messages: a timestamp row for the header
+# followed by one ``packets`` row per DATA/TRIG/SYNC word
+def msg_to_packets(msg, io_group=0, version='2.4'):
+    header, words = parse_msg_array(msg)
+    word_type = words['word_type']
+    data = word_type == word_type_table['DATA']['DATA']
+    trig = word_type == word_type_table['DATA']['TRIG']
+    sync = word_type == word_type_table['DATA']['SYNC']
+
+    packets = np.zeros(1 + len(words), dtype=dtypes[version]['packets'])
+    packets['io_group'] = io_group
+    packets[0]['packet_type'] = 4 # timestamp packet
+    packets[0]['timestamp'] = header['unix_ts']
+    word_packets = packets[1:]
+    word_packets[data] = decode_packets_v2(words['packet'][data],
+        io_group=io_group, io_channel=words['io_channel'][data],
+        receipt_timestamp=words['receipt_timestamp'][data], version=version)
+
+    trig_packets = word_packets[trig]
+    trig_packets['packet_type'] = TriggerPacket.packet_type
+    trig_packets['trigger_type'] = words['trigger_type'][trig].view(np.uint8)
+    trig_packets['timestamp'] = words['timestamp'][trig]
+    word_packets[trig] = trig_packets
+
+    sync_packets = word_packets[sync]
+    sync_packets['packet_type'] = SyncPacket.packet_type
+    sync_packets['trigger_type'] = words['sync_type'][sync].view(np.uint8)
+    sync_packets['dataword'] = words['clk_source'][sync] & 0x01
+    sync_packets['timestamp'] = words['timestamp'][sync]
+    word_packets[sync] = sync_packets
+    return packets[np.concatenate(([True], data | trig | sync))]
+
+def _set_bits(words, values, bit_slice, rows=None):
+    mask = np.uint64((1 << (bit_slice.stop - bit_slice.start)) - 1)
+    bits = (np.asarray(values).astype(np.uint64) & mask) << np.uint64(bit_slice.start)
+    if rows is not None:
+        bits[~rows] = 0
+    words |= bits
+
+# Inverse of decode_packets_v2, packs ``packets`` rows into 64-bit LArPix v2
+# words setting the same fields _parse_packets_v2_* sets per packet type
+def encode_packets_v2(packets):
+    words = np.zeros(len(packets), dtype=_packet_word_dtype)
+    names = packets.dtype.names
+    for name in ('packet_type', 'chip_id', 'downstream_marker', 'parity'):
+        _set_bits(words, packets[name], getattr(Packet_v2, name + '_bits'))
+    if 'first_packet' in names:
+        _set_bits(words, packets['first_packet'], Packet_v2.first_packet_bits)
+
+    data = packets['packet_type'] == Packet_v2.DATA_PACKET
+    for name in ('channel_id', 'dataword', 'trigger_type', 'local_fifo', 'shared_fifo'):
+        _set_bits(words, packets[name], getattr(Packet_v2, name + '_bits'), data)
+    diagnostics = data & (packets['fifo_diagnostics_enabled'] != 0)
+    _set_bits(words, packets['timestamp'], Packet_v2.timestamp_bits, data & ~diagnostics)
+    _set_bits(words, packets['timestamp'], Packet_v2.fifo_diagnostics_timestamp_bits, diagnostics)
+    _set_bits(words, packets['local_fifo_events'], Packet_v2.local_fifo_events_bits, diagnostics)
+    _set_bits(words, packets['shared_fifo_events'], Packet_v2.shared_fifo_events_bits, diagnostics)
+
+    config = np.isin(packets['packet_type'],
+        (Packet_v2.CONFIG_READ_PACKET, Packet_v2.CONFIG_WRITE_PACKET))
+    for name in ('register_address', 'register_data'):
+        _set_bits(words, packets[name], getattr(Packet_v2, name + '_bits'), config)
+    return words
+
+# Array counterpart of format(..., msg_type='DATA') over ``packets`` rows of a
+# 2.x file. Returns the DATA/SYNC/TRIG words and the row each one came from,
+# rows without a PACMAN word (timestamp/message packets) are skipped.
+def packets_to_words(packets, version='2.4'):
+    packet_type = packets['packet_type']
+    larpix = packet_type < 4
+    sync = packet_type == SyncPacket.packet_type
+    trig = packet_type == TriggerPacket.packet_type
+    if version < '2.2':
+        sync[:] = False
+        trig[:] = False
+    rows = np.flatnonzero(larpix | sync | trig)
+    packets, larpix, sync, trig = packets[rows], larpix[rows], sync[rows], trig[rows]
+
+    words = np.zeros(len(rows), dtype=msg_word_dtype)
+    words['word_type'][larpix] = word_type_table['DATA']['DATA']
+    words['io_channel'][larpix] = packets['io_channel'][larpix]
+    if 'receipt_timestamp' in packets.dtype.names and version >= '2.3':
+        words['receipt_timestamp'][larpix] = packets['receipt_timestamp'][larpix]
+    words['packet'][larpix] = encode_packets_v2(packets[larpix])
+
+    words['word_type'][sync] = word_type_table['DATA']['SYNC']
+    words['sync_type'][sync] = packets['trigger_type'][sync].view('S1')
+    words['clk_source'][sync] = packets['dataword'][sync]
+    words['timestamp'][sync] = packets['timestamp'][sync]
+
+    words['word_type'][trig] = word_type_table['DATA']['TRIG']
+    words['trigger_type'][trig] = packets['trigger_type'][trig].view('S1')
+    words['timestamp'][trig] = packets['timestamp'][trig]
+    return words, rows
+
+def set_msg_unix_ts(msg, unix_ts=None):
+    # restamps the header of an (array backed) message in place
+    if unix_ts is None:
+        unix_ts = int(time.time())
+    np.frombuffer(msg, dtype=msg_header_dtype, count=1)['unix_ts'] = unix_ts
+
+def copy_msgs(msgs, msg_offsets, first, last, unix_ts=None):
+    # Copy of messages [first, last) of a (read-only) message buffer with
+    # their headers restamped, and their byte offsets in the copy
+    if unix_ts is None:
+        unix_ts = int(time.time())
+    start = msg_offsets[first]
+    batch = bytearray(msgs[start:msg_offsets[last]])
+    offsets = msg_offsets[first:last + 1] - start
+    batch_bytes = np.frombuffer(batch, dtype=np.uint8)
+    for i, byte in enumerate(int(unix_ts).to_bytes(4, 'little')):
+        batch_bytes[offsets[:-1] + 1 + i] = byte
+    return batch, offsets
+
+def iter_msgs(msgs, msg_offsets):
+    for start, end in zip(msg_offsets[:-1], msg_offsets[1:]):
+        yield msgs[start:end]
+
+# Chip keys packed into one uint32 as io_group << 16 | io_channel << 8 | chip_id,
+# the array counterpart of Key.packed
+chip_key_dtype = np.dtype('<u4')
+
+def pack_chip_keys(io_group, io_channel, chip_id):
+    return ((np.asarray(io_group).astype(chip_key_dtype) << np.uint32(16))
+        | (np.asarray(io_channel).astype(chip_key_dtype) << np.uint32(8))
+        | np.asarray(chip_id).astype(chip_key_dtype))
+
+def unpack_chip_keys(keys):
+    keys = np.asarray(keys, dtype=chip_key_dtype)
+    return (((keys >> np.uint32(16)) & np.uint32(0xff)).astype(np.uint8),
+        ((keys >> np.uint32(8)) & np.uint32(0xff)).astype(np.uint8),
+        (keys & np.uint32(0xff)).astype(np.uint8))
+
+def _unique_strings(strings):
+    # np.unique(strings, return_inverse=True) without sorting the strings:
+    # rows are grouped on a 64-bit mix of their 8-byte words, and only if a
+    # mix collision gives a row another row's string the strings are sorted
+    strings = np.ascontiguousarray(strings)
+    if len(strings) == 0 or strings.dtype.itemsize % 8:
+        return np.unique(strings, return_inverse=True)
+    words = strings.view('<u8').reshape(len(strings), -1)
+    mix = np.zeros(len(strings), dtype=np.uint64)
+    for column in words.T:
+        mix = (mix * np.uint64(0x9E3779B97F4A7C15)) ^ column
+    _, first, inverse = np.unique(mix, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    if not (words[first][inverse] == words).all():
+        return np.unique(strings, return_inverse=True)
+    return strings[first], inverse
+
+# Packs chip key strings (b'io_group-io_channel-chip_id', empty for packets
+# without a chip) parsing each distinct string once
+def parse_chip_keys(chip_keys):
+    unique_strings, inverse = _unique_strings(chip_keys)
+    unique_keys = np.array([Key(keystring).packed if keystring else 0
+        for keystring in unique_strings], dtype=chip_key_dtype)
+    return unique_keys[inverse.ravel()]
+
+def packet_chip_keys(packets):
+    return pack_chip_keys(packets['io_group'], packets['io_channel'], packets['chip_id'])
+
+# Groups the LArPix (packet_type < 4) ``packets`` rows by chip. Returns a dict
+# of Key to the row indices of that chip in file order, each a slice of one
+# shared index array.
+def group_by_chip(packets):
+    rows = np.flatnonzero(packets['packet_type'] < 4)
+    keys = packet_chip_keys(packets)[rows]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    rows = rows[order]
+    unique_keys, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    return dict((Key.from_packed(key), rows[start:end])
+        for key, start, end in zip(unique_keys, starts, ends))
+
+#-----------------------------------------------------------------------------
+# Message cache section
+#-----------------------------------------------------------------------------
+
+import os
+import hashlib
+
+_msg_cache_version = '3'
+default_msg_cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'lbrulibs')
+
+_max_msg_words = 0xffff # word count of a message header is a u2
+
+def segment_msgs(packets, max_gap=None, max_words=_max_msg_words):
+    # Splits ``packets`` rows into PACMAN messages. A message starts at the
+    # first row, at each timestamp packet, at each LArPix packet received more
+    # than max_gap ticks after the previous one and after every max_words
+    # PACMAN words (see packets_to_words). Returns the first row of each
+    # message with len(packets) appended, ready to map onto word offsets.
+    packet_type = packets['packet_type']
+    starts = [np.zeros(1, dtype=np.int64),
+        np.flatnonzero(packet_type == 4)] # timestamp packets
+    if max_gap is not None:
+        timed = np.flatnonzero(_timed_rows(packets, 'receipt_timestamp'))
+        step = np.diff(packets['receipt_timestamp'][timed].astype(np.int64))
+        starts.append(timed[1:][step > max_gap])
+    starts = np.unique(np.concatenate(starts))
+    if max_words:
+        word_rows = np.flatnonzero((packet_type < 4)
+            | (packet_type == SyncPacket.packet_type)
+            | (packet_type == TriggerPacket.packet_type))
+        first_words = np.searchsorted(word_rows, starts)
+        message = np.searchsorted(starts, word_rows, side='right') - 1
+        position = np.arange(len(word_rows)) - first_words[message]
+        full = (position > 0) & (position % max_words == 0)
+        starts = np.union1d(starts, word_rows[full])
+    starts = starts[starts < len(packets)]
+    return np.append(starts, len(packets))
+
+def hdf5_to_msgs(filename, version=None, unix_ts=None, max_gap=None, max_words=_max_msg_words):
+    # Converts a larpix HDF5 file into back to back PACMAN DATA messages split
+    # by segment_msgs, skipping the messages without words. Returns the
+    # message buffer and byte offsets. Each header carries the unix time of
+    # the last timestamp packet before the message (the first one for
+    # messages before it, the current time without any), unless unix_ts is
+    # given.
+    with h5py.File(filename, 'r') as f:
+        version = _resolve_version(f['_header'].attrs['version'], version)
+        packets = f['packets'][:]
+    words, rows = packets_to_words(packets, version)
+    row_offsets = segment_msgs(packets, max_gap, max_words)
+    word_offsets = np.unique(np.searchsorted(rows, row_offsets))
+    if unix_ts is None:
+        ts_rows = np.flatnonzero(packets['packet_type'] == 4) # timestamp packets
+        if len(ts_rows):
+            first_rows = rows[word_offsets[:-1]]
+            last_ts = np.maximum(np.searchsorted(ts_rows, first_rows, side='right') - 1, 0)
+            unix_ts = packets['timestamp'][ts_rows[last_ts]]
+    return format_msgs_array('DATA', words, word_offsets, unix_ts)
+
+def _msg_cache_paths(filename, cache_dir):
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    with h5py.File(filename, 'r') as f:
+        file_version = f['_header'].attrs['version']
+    key = hashlib.sha1('|'.join((filename, str(stat.st_size), str(stat.st_mtime_ns),
+        file_version, _msg_cache_version)).encode()).hexdigest()[:16]
+    base = os.path.join(cache_dir, '{}.{}'.format(os.path.basename(filename), key))
+    return base + '.msgs', base + '.idx'
+
+def pacman_msg_cache(filename, cache_dir=None, rebuild=False):
+    # Returns the PACMAN messages of hdf5_to_msgs(filename) from an on-disk
+    # cache keyed by the file path, size, mtime and version, building it on
+    # first use. The messages are a read-only memory map shared by every
+    # process reading the cache, restamp copies of them (copy_msgs).
+    if cache_dir is None:
+        cache_dir = default_msg_cache_dir
+    msgs_path, idx_path = _msg_cache_paths(filename, cache_dir)
+    if rebuild or not (os.path.exists(msgs_path) and os.path.exists(idx_path)):
+        msgs, msg_offsets = hdf5_to_msgs(filename)
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, write in ((msgs_path, lambda f: f.write(msgs)),
+                (idx_path, lambda f: np.save(f, msg_offsets))):
+            with open(path + '.tmp', 'wb') as f:
+                write(f)
+            os.replace(path + '.tmp', path)
+    msg_offsets = np.load(idx_path)
+    if msg_offsets[-1] == 0:
+        return np.zeros(0, dtype=np.uint8), msg_offsets
+    return np.memmap(msgs_path, dtype=np.uint8, mode='r'), msg_offsets
+
+
+#-----------------------------------------------------------------------------
+# C library section
+#-----------------------------------------------------------------------------
+
+# Bulk message walking and packet decoding with the accessors of larpix.c,
+# compiled on first use into the cache directory. Without a working compiler
+# (or with LARPIX_NO_C set) the same functions run on the numpy code above.
+
+import ctypes
+import subprocess
+
+_larpix_c_dir = os.path.dirname(os.path.abspath(__file__))
+_larpix_c_lib = None # False once the build failed
+
+_packet_field_names = ('packet_type', 'chip_id', 'channel_id', 'timestamp',
+    'first_packet', 'dataword', 'trigger_type', 'local_fifo', 'shared_fifo',
+    'downstream_marker', 'parity')
+
+def _c_array(dtype):
+    return np.ctypeslib.ndpointer(dtype=dtype, flags='C_CONTIGUOUS')
+
+def load_larpix_c(rebuild=False):
+    # Returns the larpix.c ctypes library, or None if it can't be built
+    global _larpix_c_lib
+    if _larpix_c_lib is not None and not rebuild:
+        return _larpix_c_lib or None
+    _larpix_c_lib = False
+    if os.environ.get('LARPIX_NO_C'):
+        return None
+    source = os.path.join(_larpix_c_dir, 'larpix.c')
+    try:
+        digest = hashlib.sha1()
+        for name in ('larpix.c', 'larpix.h'):
+            with open(os.path.join(_larpix_c_dir, name), 'rb') as f:
+                digest.update(f.read())
+        lib_path = os.path.join(default_msg_cache_dir,
+            'liblarpix.{}.so'.format(digest.hexdigest()[:16]))
+        if rebuild or not os.path.exists(lib_path):
+            os.makedirs(default_msg_cache_dir, exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(lib_path, os.getpid())
+            subprocess.run([os.environ.get('CC', 'cc'), '-O2', '-shared', '-fPIC',
+                '-o', tmp_path, source], check=True, capture_output=True)
+            os.replace(tmp_path, lib_path)
+        lib = ctypes.CDLL(lib_path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        warnings.warn('larpix.c not available, using numpy fallback ({})'.format(e))
+        return None
+
+    lib.count_msg_words.restype = ctypes.c_int64
+    lib.count_msg_words.argtypes = [_c_array(np.uint8), ctypes.c_uint64,
+        ctypes.POINTER(ctypes.c_uint64)]
+    lib.walk_msgs.restype = ctypes.c_uint64
+    lib.walk_msgs.argtypes = [_c_array(np.uint8), ctypes.c_uint64, ctypes.c_uint64,
+        _c_array(msg_word_dtype), _c_array(np.uint32), _c_array(np.uint32)]
+    lib.decode_packets.restype = None
+    lib.decode_packets.argtypes = [_c_array(np.uint64), ctypes.c_uint64] + [
+        _c_array(np.uint64 if name == 'timestamp' else np.uint8)
+        for name in _packet_field_names]
+    _larpix_c_lib = lib
+    return lib
+
+def _msg_offsets(buf):
+    # message start offsets of a buffer of back to back messages
+    offsets = [0]
+    while offsets[-1] + HEADER_LEN <= len(buf):
+        header = buf[offsets[-1]:offsets[-1] + HEADER_LEN].view(msg_header_dtype)[0]
+        offsets.append(offsets[-1] + HEADER_LEN + WORD_LEN * int(header['words']))
+    if offsets[-1] != len(buf):
+        raise ValueError('Truncated message at byte {}'.format(offsets[-2]))
+    return np.array(offsets, dtype=np.int64)
+
+def count_msg_words(msgs):
+    # (number of words, number of messages) in a buffer of back to back messages
+    buf = np.frombuffer(msgs, dtype=np.uint8)
+    lib = load_larpix_c()
+    if lib is None:
+        offsets = _msg_offsets(buf)
+        return (int((offsets[-1] - HEADER_LEN * (len(offsets) - 1)) // WORD_LEN),
+            len(offsets) - 1)
+    n_msgs = ctypes.c_uint64(0)
+    n_words = lib.count_msg_words(buf, len(buf), ctypes.byref(n_msgs))
+    if n_words < 0:
+        raise ValueError('Truncated message in buffer')
+    return n_words, n_msgs.value
+
+def walk_msgs(msgs, words=None, msg_index=None, unix_ts=None):
+    # Splits a buffer of back to back PACMAN messages (as from
+    # pacman_msg_cache) into its words. Fills the given msg_word_dtype words
+    # and per word uint32 msg_index/unix_ts arrays, allocating those not
+    # given, and returns the filled parts.
+    buf = np.frombuffer(msgs, dtype=np.uint8)
+    n_words, n_msgs = count_msg_words(buf)
+    if words is None:
+        words = np.zeros(n_words, dtype=msg_word_dtype)
+    if msg_index is None:
+        msg_index = np.zeros(n_words, dtype=np.uint32)
+    if unix_ts is None:
+        unix_ts = np.zeros(n_words, dtype=np.uint32)
+    if min(len(words), len(msg_index), len(unix_ts)) < n_words:
+        raise ValueError('Output arrays need room for {} words'.format(n_words))
+
+    lib = load_larpix_c()
+    if lib is not None:
+        lib.walk_msgs(buf, len(buf), n_words, words, msg_index, unix_ts)
+    else:
+        offsets = _msg_offsets(buf)
+        i = 0
+        for i_msg, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            header, msg_words = parse_msg_array(buf[start:end])
+            words[i:i + len(msg_words)] = msg_words
+            msg_index[i:i + len(msg_words)] = i_msg
+            unix_ts[i:i + len(msg_words)] = header['unix_ts']
+            i += len(msg_words)
+    return words[:n_words], msg_index[:n_words], unix_ts[:n_words]
+
+def decode_packet_fields(packets, out=None):
+    # Per field arrays (dict of _packet_field_names) of 64-bit LArPix v2 words,
+    # filling the arrays in ``out`` where given
+    packets = np.ascontiguousarray(_as_packet_words(packets))
+    out = dict() if out is None else out
+    for name in _packet_field_names:
+        if name not in out:
+            out[name] = np.zeros(len(packets), dtype=np.uint64 if name == 'timestamp' else np.uint8)
+    lib = load_larpix_c()
+    if lib is not None:
+        lib.decode_packets(packets, len(packets), *[out[name] for name in _packet_field_names])
+    else:
+        for name in _packet_field_names:
+            out[name][:len(packets)] = _get_bits(packets, getattr(Packet_v2, name + '_bits'))
+    return out
+
+
+#-----------------------------------------------------------------------------
+# Time index section
+#-----------------------------------------------------------------------------
+
+# A sidecar HDF5 file (<file>.tidx) next to a packet file holding, for every
+# block of ``stride`` rows and io_group in it, the min/max of the
+# unwrap_timestamps clock of receipt_timestamp and timestamp over the rows and
+# the unwrap state the block starts from, plus the segment_msgs rows (with
+# default arguments, the messages of hdf5_to_msgs). read_time_range uses it to
+# read only the rows of a time window.
+
+from numpy.lib import recfunctions
+
+_time_index_version = '4'
+_time_index_fields = ('receipt_timestamp', 'timestamp')
+_time_index_dtype = np.dtype([
+    ('row', '<u8'),
+    ('io_group', 'u1'),
+    ] + [(time_field + suffix, '<i8') for time_field in _time_index_fields
+        for suffix in ('_min', '_max', '_offset', '_wraps', '_last')])
+
+def _timed_rows(packets, time_field):
+    # rows with a meaningful value of time_field: receipt_timestamp is set on
+    # larpix packets (0 if unknown), timestamp is on the PACMAN clock for
+    # data, sync and trigger packets
+    packet_type = packets['packet_type']
+    if time_field == 'receipt_timestamp':
+        return (packet_type < 4) & (packets['receipt_timestamp'] != 0)
+    if time_field == 'timestamp':
+        return ((packet_type == Packet_v2.DATA_PACKET)
+            | (packet_type == SyncPacket.packet_type)
+            | (packet_type == TriggerPacket.packet_type))
+    raise ValueError('No time index on field {}'.format(time_field))
+
+def time_index_filename(filename):
+    return filename + '.tidx'
+
+def _time_index_source(filename):
+    stat = os.stat(filename)
+    return dict(source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns,
+        index_version=_time_index_version)
+
+# fields unwrap_timestamps reads besides the time field
+_unwrap_fields = ('packet_type', 'io_group', 'trigger_type', 'timestamp')
+
+def build_time_index(filename, stride=4096, chunk_rows=1<<20):
+    chunk_rows = max(chunk_rows // stride, 1) * stride
+    with h5py.File(filename, 'r') as f:
+        version = _resolve_version(f['_header'].attrs['version'])
+        fields = _unwrap_fields + ('receipt_timestamp',)
+        if 'fifo_diagnostics_enabled' in f['packets'].dtype.names:
+            fields += ('fifo_diagnostics_enabled',)
+    if version < '2.3':
+        raise RuntimeError('Time index needs receipt timestamps (version >= 2.3), got %s' % version)
+
+    checkpoints = []
+    states = dict((time_field, dict()) for time_field in _time_index_fields)
+    row = 0
+    for packets in iter_file(filename, chunk_rows=chunk_rows, fields=fields):
+        for block_start in range(0, len(packets), stride):
+            block = packets[block_start:block_start + stride]
+            io_groups = np.unique(block['io_group'])
+            block_checkpoints = np.zeros(len(io_groups), dtype=_time_index_dtype)
+            block_checkpoints['row'] = row + block_start
+            block_checkpoints['io_group'] = io_groups
+            inverse = np.searchsorted(io_groups, block['io_group'])
+            for time_field in _time_index_fields:
+                # the state the block starts from, to unwrap a read from here
+                state = states[time_field]
+                for i, io_group in enumerate(io_groups):
+                    offset, wraps, last = state.get(int(io_group), (0, 0, None))
+                    block_checkpoints[time_field + '_offset'][i] = offset
+                    block_checkpoints[time_field + '_wraps'][i] = wraps
+                    block_checkpoints[time_field + '_last'][i] = -1 if last is None else last
+                t = unwrap_timestamps(block, state, time_field)
+                timed = t >= 0
+                # rows off the clock don't widen the range
+                t_min = np.full(len(io_groups), np.iinfo(np.int64).max)
+                t_max = np.full(len(io_groups), -1, dtype=np.int64)
+                np.minimum.at(t_min, inverse[timed], t[timed])
+                np.maximum.at(t_max, inverse[timed], t[timed])
+                block_checkpoints[time_field + '_min'] = t_min
+                block_checkpoints[time_field + '_max'] = t_max
+            checkpoints.append(block_checkpoints)
+        row += len(packets)
+    checkpoints = np.concatenate(checkpoints) if checkpoints else np.zeros(0, dtype=_time_index_dtype)
+    # messages can span chunks, segment the whole packet_type column at once
+    with h5py.File(filename, 'r') as f:
+        breaks = segment_msgs(f['packets'].fields(['packet_type'])[:])
+
+    index_filename = time_index_filename(filename)
+    tmp_filename = index_filename + '.tmp'
+    with h5py.File(tmp_filename, 'w') as f:
+        f.attrs.update(_time_index_source(filename))
+        f.attrs['stride'] = stride
+        f.attrs['n_rows'] = row
+        f.create_dataset('checkpoints', data=checkpoints)
+        f.create_dataset('msg_breaks', data=breaks.astype('<u8'))
+    os.replace(tmp_filename, index_filename)
+    return index_filename
+
+def load_time_index(filename, build=True, stride=4096):
+    # Returns the time index of filename as a dict, (re)building the sidecar
+    # if it is missing or older than the file and build is set
+    index_filename = time_index_filename(filename)
+    for attempt in range(2):
+        if os.path.exists(index_filename):
+            with h5py.File(index_filename, 'r') as f:
+                if all(f.attrs.get(key) == value
+                        for key, value in _time_index_source(filename).items()):
+                    return dict(
+                        checkpoints=f['checkpoints'][:],
+                        msg_breaks=f['msg_breaks'][:],
+                        stride=int(f.attrs['stride']),
+                        n_rows=int(f.attrs['n_rows']),
+                        )
+        if not build or attempt:
+            break
+        build_time_index(filename, stride=stride)
+    raise RuntimeError('No up to date time index for {}'.format(filename))
+
+def time_range_rows(index, t0, t1, io_group=None, time_field='receipt_timestamp'):
+    # [start, end) rows that hold every row with t0 <= t < t1, t the
+    # unwrap_timestamps clock of time_field from the start of the file
+    checkpoints = index['checkpoints']
+    if io_group is not None:
+        checkpoints = checkpoints[checkpoints['io_group'] == io_group]
+    t_min = checkpoints[time_field + '_min']
+    t_max = checkpoints[time_field + '_max']
+    # blocks are in row order, the running max of t_max / trailing min of
+    # t_min are sorted and bound the blocks that can overlap [t0, t1)
+    first = np.searchsorted(np.maximum.accumulate(t_max), t0, side='left')
+    last = np.searchsorted(np.minimum.accumulate(t_min[::-1])[::-1], t1, side='left')
+    if first >= last:
+        return 0, 0
+    return (int(checkpoints['row'][first]),
+        min(int(checkpoints['row'][last - 1]) + index['stride'], index['n_rows']))
+
+def _time_index_state(index, row, time_field):
+    # unwrap_timestamps state at row (a block start): per io_group, the state
+    # of its first block at or after row, no rows of the io_group lie between
+    checkpoints = index['checkpoints']
+    checkpoints = checkpoints[checkpoints['row'] >= row]
+    io_groups, first = np.unique(checkpoints['io_group'], return_index=True)
+    state = dict()
+    for io_group, checkpoint in zip(io_groups, checkpoints[first]):
+        last = int(checkpoint[time_field + '_last'])
+        state[int(io_group)] = (int(checkpoint[time_field + '_offset']),
+            int(checkpoint[time_field + '_wraps']), None if last < 0 else last)
+    return state
+
+def read_time_range(filename, t0, t1, io_group=None, time_field='receipt_timestamp',
+        fields=None, index=None):
+    # Reads the packets rows with t0 <= t < t1 (and of io_group), t the
+    # unwrap_timestamps clock of time_field from the start of the file, using
+    # the time index to read a single hyperslab of the packets dataset
+    if index is None:
+        index = load_time_index(filename)
+    start, end = time_range_rows(index, t0, t1, io_group, time_field)
+    with h5py.File(filename, 'r') as f:
+        dset = f['packets']
+        if fields is not None:
+            read_fields = list(fields)
+            for name in _unwrap_fields + (time_field, 'fifo_diagnostics_enabled'):
+                if name in dset.dtype.names and name not in read_fields:
+                    read_fields.append(name)
+            dset = dset.fields(read_fields)
+        packets = dset[start:end]
+    t = unwrap_timestamps(packets, _time_index_state(index, start, time_field), time_field)
+    mask = (t >= 0) & (t >= t0) & (t < t1)
+    if io_group is not None:
+        mask &= packets['io_group'] == io_group
+    packets = packets[mask]
+    if fields is not None:
+        packets = recfunctions.repack_fields(packets[list(fields)])
+    return packets
+
+#-----------------------------------------------------------------------------
+# Clock section
+#-----------------------------------------------------------------------------
+
+# LArPix timestamps count a 10 MHz clock in 31 bits, the PACMAN (receipt,
+# sync and trigger) timestamps the same clock in 32 bits. Both wrap around and
+# restart from 0 at each SYNC ('S') sync packet of their io_group, heartbeat
+# ('H') and clock switch ('C') sync packets do not reset them.
+
+import math
+
+larpix_clock_hz = 10000000
+dune_clock_hz = 62500000
+_clock_bits = dict(timestamp=31, receipt_timestamp=32)
+
+def _clock_values(packets, time_field):
+    # rows on the clock of time_field and their counter values, sync and
+    # trigger packets carry the PACMAN time in timestamp
+    packet_type = packets['packet_type']
+    pacman_rows = ((packet_type == SyncPacket.packet_type)
+        | (packet_type == TriggerPacket.packet_type))
+    rows = _timed_rows(packets, time_field) | pacman_rows
+    if time_field == 'timestamp' and 'fifo_diagnostics_enabled' in packets.dtype.names:
+        # 16-bit timestamps of fifo diagnostics packets cannot be unwrapped
+        rows &= packets['fifo_diagnostics_enabled'] == 0
+    rows = np.flatnonzero(rows)
+    values = packets[time_field][rows].astype(np.int64)
+    if time_field != 'timestamp':
+        pacman = pacman_rows[rows]
+        values[pacman] = packets['timestamp'][rows[pacman]]
+    return rows, values & ((1 << _clock_bits[time_field]) - 1)
+
+def unwrap_timestamps(packets, state=None, time_field='timestamp', dune_ticks=False):
+    # Rebuilds a monotonic 64-bit clock from the wrapping time_field of
+    # ``packets`` rows, per io_group: a step back by more than half the
+    # counter range is a rollover (and a step forward by as much a late packet
+    # from before one), a SYNC sync packet ends the clock epoch and the next
+    # one starts at its time. Returns int64 clock ticks since the first epoch
+    # (or DUNE 62.5 MHz ticks with dune_ticks), -1 on rows off the clock.
+    # Pass the same state dict for consecutive chunks of a file to carry the
+    # epochs and rollovers over.
+    if state is None:
+        state = dict()
+    period = 1 << _clock_bits[time_field]
+    half = period >> 1
+    times = np.full(len(packets), -1, dtype=np.int64)
+    rows, values = _clock_values(packets, time_field)
+    resets = ((packets['packet_type'][rows] == SyncPacket.packet_type)
+        & (packets['trigger_type'][rows] == ord(WORD_TYPE_SYNC)))
+    io_groups = packets['io_group'][rows]
+    for io_group in np.unique(io_groups):
+        group = np.flatnonzero(io_groups == io_group)
+        ts = values[group]
+        reset = resets[group]
+        offset, wraps, last = state.get(int(io_group), (0, 0, None))
+
+        # rollovers between consecutive rows of an epoch, rows after a reset
+        # start the next epoch from 0
+        step = np.diff(ts, prepend=ts[0] if last is None else last)
+        rollover = (step < -half).astype(np.int64) - (step > half)
+        rollover[1:][reset[:-1]] = 0
+        epoch = np.cumsum(reset) - reset
+        n_rollovers = np.cumsum(rollover)
+        starts = np.flatnonzero(reset[:-1]) + 1
+        n_rollovers -= np.concatenate(([-wraps], n_rollovers[starts]))[epoch]
+        epoch_ts = ts + n_rollovers * period
+
+        epoch_offsets = offset + np.concatenate(([0], np.cumsum(epoch_ts[reset])))
+        times[rows[group]] = epoch_offsets[epoch] + epoch_ts
+        if reset[-1]:
+            state[int(io_group)] = (int(epoch_offsets[-1]), 0, None)
+        else:
+            state[int(io_group)] = (int(epoch_offsets[-1]), int(n_rollovers[-1]), int(ts[-1]))
+    if dune_ticks:
+        clocked = times >= 0
+        gcd = math.gcd(dune_clock_hz, larpix_clock_hz)
+        times[clocked] = times[clocked] * (dune_clock_hz // gcd) // (larpix_clock_hz // gcd)
+    return times
+
+def extract_windows(packets, trigger_ts, before, after, time_field='timestamp', times=None):
+    # Finds the rows of ``packets`` in the readout window of each trigger,
+    # trigger_ts - before <= t < trigger_ts + after, on time_field or on the
+    # given per-row times (e.g. unwrap_timestamps(packets, dune_ticks=True)
+    # to use DUNE trigger window ticks, rows < 0 are skipped). Returns the
+    # timed rows in time order and the [start, end) of each trigger's window
+    # in them: the rows of trigger i are order[starts[i]:ends[i]], windows may
+    # overlap and share rows.
+    if times is None:
+        order = np.flatnonzero(_timed_rows(packets, time_field))
+        times = packets[time_field][order].astype(np.int64)
+    else:
+        times = np.asarray(times, dtype=np.int64)
+        order = np.flatnonzero(times >= 0)
+        times = times[order]
+    if np.any(times[1:] < times[:-1]):
+        time_order = np.argsort(times, kind='stable')
+        order = order[time_order]
+        times = times[time_order]
+    trigger_ts = np.asarray(trigger_ts, dtype=np.int64)
+    starts = np.searchsorted(times, trigger_ts - before, side='left')
+    ends = np.searchsorted(times, trigger_ts + after, side='left')
+    return order, starts, ends
+
+
 #-----------------------------------------------------------------------------
 # Application section
 #-----------------------------------------------------------------------------
@@ -9,14 +9,17 @@ import larpixtools
 data = 'tcp://127.0.0.1:5556'
 N_READOUTS = 1 #number of readouts
 datafile = "readout-test-RAW.h5"
+VERBOSE = True #print every message and its packets, disable to record at full rate
 
 def readout():
+    # Using STREAM socket to collect data
+    print("Initialising...")
+    reader = zmq.Context().socket(zmq.STREAM)
+    #reader.bind(data)
+    reader.bind(data)
+    print("Writing to HDF5 file:", datafile)
+    writer = larpixtools.PacketFileWriter(datafile)
     try:
-        # Using STREAM socket to collect data
-        print("Initialising...")
-        reader = zmq.Context().socket(zmq.STREAM)
-        #reader.bind(data)
-        reader.bind(data)
         time.sleep(1)
         print("Press ENTER to start listening...")
         input()
@@ -28,22 +31,23 @@ def readout():
             # need to receive two messages, or recv_multipart()
             id = reader.recv()
             message = reader.recv()
-            print("Message received:", message, "from:",id)
+            if VERBOSE:
+                print("Message received:", message, "from:",id)
             if message != b"":
                 messages += 1
-                print("Total messages received:", messages)
-   
-                print("Converting to a packet...")
-                packet = larpixtools.parse(message)
-                print(packet)
-                #print("Writing to HDF5 file:", datafile)
-                #larpix.format.hdf5format.to_file(datafile,packet)
-                #print("Message written to file.")
+                # buffered, written out by the writer's background thread
+                writer.append(larpixtools.msg_to_packets(message))
+                if VERBOSE:
+                    print("Total messages received:", messages)
+                    print("Converting to a packet...")
+                    packet = larpixtools.parse(message)
+                    print(packet)
             
             
     except:
         raise
     finally:
+        writer.close()
         reader.close()
 
 
@@ -10,10 +10,14 @@
 #ifndef LBRULIBS_SRC_STREAMLINKCONCEPT_HPP_
 #define LBRULIBS_SRC_STREAMLINKCONCEPT_HPP_
 
+#include "ZMQIssues.hpp"
 #include "zmq.hpp"
 
 #include <nlohmann/json.hpp>
 
+#include <pthread.h>
+#include <sched.h>
+
 #include <memory>
 #include <sstream>
 #include <string>
@@ -50,6 +54,14 @@ public:
         m_link_tag = tag;
     }
 
+    void set_source_link(const std::string& source_link) {
+        m_STREAMLink_sourceLink = source_link;
+    }
+
+    void set_cpu_core(int cpu_core) {
+        m_cpu_core = cpu_core;
+    }
+
 protected:
     dunedaq::lbrulibs::pacmancardreader::Conf m_cfg;
     std::chrono::milliseconds m_queue_timeout;
@@ -59,7 +71,42 @@ protected:
     zmq::socket_t m_subscriber{m_context, zmq::socket_type::stream};
     int m_card_id;
     int m_link_tag;
+    int m_cpu_core{-1}; // core the parser thread is pinned to, -1 for no pinning
     std::string m_STREAMLink_sourceLink = "tcp://127.0.0.1:5556";
+
+    // Recreates context and subscriber socket with the ZMQ tuning in m_cfg,
+    // needs to happen before the socket is bound/connected
+    void setup_socket() {
+        m_subscriber.close();
+        m_context = zmq::context_t();
+        m_context.set(zmq::ctxopt::io_threads, m_cfg.zmq_io_threads);
+#ifdef ZMQ_THREAD_AFFINITY_CPU_ADD
+        for (auto cpu : m_cfg.zmq_io_thread_cpus) {
+            m_context.set(zmq::ctxopt::thread_affinity_cpu_add, cpu);
+        }
+#endif
+        m_subscriber = zmq::socket_t(m_context, zmq::socket_type::stream);
+        m_subscriber.set(zmq::sockopt::rcvhwm, m_cfg.zmq_rcvhwm);
+        m_subscriber.set(zmq::sockopt::rcvbuf, m_cfg.zmq_rcvbuf);
+        m_subscriber.set(zmq::sockopt::tcp_keepalive, m_cfg.tcp_keepalive);
+        m_subscriber.set(zmq::sockopt::tcp_keepalive_idle, m_cfg.tcp_keepalive_idle);
+        m_subscriber.set(zmq::sockopt::tcp_keepalive_cnt, m_cfg.tcp_keepalive_cnt);
+        m_subscriber.set(zmq::sockopt::tcp_keepalive_intvl, m_cfg.tcp_keepalive_intvl);
+    }
+
+    // Pins the calling (parser) thread to m_cpu_core, if set
+    void pin_current_thread() {
+        if (m_cpu_core < 0) {
+            return;
+        }
+        cpu_set_t cpuset;
+        CPU_ZERO(&cpuset);
+        CPU_SET(m_cpu_core, &cpuset);
+        if (pthread_setaffinity_np(pthread_self(), sizeof(cpu_set_t), &cpuset) != 0) {
+            ers::warning(GenericNDMessage(ERS_HERE, "Unable to pin link " + std::to_string(m_link_tag) +
+                                                      " thread to CPU core " + std::to_string(m_cpu_core)));
+        }
+    }
 private:
 
 };
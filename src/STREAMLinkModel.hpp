@@ -22,7 +22,9 @@
 #include <nlohmann/json.hpp>
 #include <folly/ProducerConsumerQueue.h>
 
+#include <algorithm>
 #include <string>
+#include <vector>
 #include <mutex>
 #include <atomic>
 #include <memory>
@@ -86,6 +88,7 @@ public:
       m_queue_timeout = std::chrono::milliseconds(m_cfg.zmq_receiver_timeout);
       TLOG(TLVL_WORK_STEPS) << "STREAMLinkModel conf: initialising subscriber!";
       m_subscriber_connected = false;
+      setup_socket();
       //m_subscriber.setsockopt(ZMQ_SUBSCRIBE, "", 0);
       TLOG(TLVL_WORK_STEPS) << "STREAMLinkModel conf: connecting subscriber!";
       m_subscriber.bind(m_STREAMLink_sourceLink);
@@ -94,6 +97,8 @@ public:
       //m_subscriber.setsockopt(ZMQ_SUBSCRIBE, "");
      
       m_parser_thread.set_name(m_STREAMLink_sourceLink, m_link_tag);
+      // payloads are reused across drains, sized once here
+      m_payload_pool.resize(std::max<size_t>(1, m_cfg.drain_batch_size));
       m_configured=true;
     } 
   }
@@ -153,6 +158,7 @@ private:
 
   // mesages to process
   UniqueMessageAddrQueue m_message_addr_queue;
+  std::vector<TargetPayloadType> m_payload_pool; //payloads filled by one drain of the socket
   size_t m_packetCounter = 0; //number of packets
   int m_packetsizesum = 0; //sum of data across monitoring period
   int m_packetsize = 0; //last packet size
@@ -195,9 +201,7 @@ private:
   void process_STREAMLink() {
 
     TLOG_DEBUG(1) << "Starting ZMQ link process";
-
-    
-    std::ostringstream oss;
+    pin_current_thread();
 
     zmq::pollitem_t items[] = {{static_cast<void*>(m_subscriber),0,ZMQ_POLLIN,0}};
     while (m_run_marker.load()) {
@@ -205,40 +209,13 @@ private:
         
         if (m_subscriber_connected) {
             TLOG_DEBUG(1) << ": Ready to receive data";
-            zmq::message_t id; //routing frame
-            zmq::message_t msg;
             zmq::poll (&items [0],1,m_queue_timeout);
-	    if (items[0].revents & ZMQ_POLLIN){
-              auto recvd = m_subscriber.recv(id); //routing frame
-              if (recvd == 0) {
-                m_rcvd_zero++;
-                TLOG_DEBUG(1) << "No data received, moving to next loop iteration";
-                continue;
-              }
-              recvd = m_subscriber.recv(msg);
-              if (recvd == 0) {
-		m_rcvd_zero++;
-                TLOG_DEBUG(1) << "No data received, moving to next loop iteration";
-                continue;
-              }
-              if (msg.data() == 0){//empty message for establishing connections
-                TLOG_DEBUG(1) << "No data received, moving to next loop iteration";
-                continue;
-              }
-              TLOG_DEBUG(1) << ": Pushing data into output_queue";
-              try {
-		TargetPayloadType* Payload = new TargetPayloadType();
-		Payload -> load_message(msg.data(), msg.size()) ; 
-		m_timestamp = Payload->get_timestamp() ; 
-                m_sink_queue->send(std::move(*Payload), m_sink_timeout);
-		m_packetsizesum += msg.size(); //sum of data from packets
-	       	m_packetsize = msg.size(); //last packet size
-              } catch (const iomanager::TimeoutExpired& ex) {
-                ers::warning(ex);
-              }
-
+            if (items[0].revents & ZMQ_POLLIN){
+              // one poll, then drain whatever is already queued on the socket
+              size_t n_loaded = drain_messages();
+              TLOG_DEBUG(1) << ": Pushing " << n_loaded << " payloads into output_queue";
+              flush_payloads(n_loaded);
               TLOG_DEBUG(1) << ": End of do_work loop";
-              m_packetCounter++;
             }
 
         } else {
@@ -246,6 +223,45 @@ private:
         }
     }
   }
+
+  // Receives up to m_payload_pool.size() routing-id/payload pairs without blocking,
+  // loading them into the payload pool. Returns the number of payloads loaded.
+  size_t drain_messages() {
+    size_t n_loaded = 0;
+    zmq::message_t id; //routing frame
+    zmq::message_t msg;
+    while (n_loaded < m_payload_pool.size()) {
+      auto recvd = m_subscriber.recv(id, zmq::recv_flags::dontwait); //routing frame
+      if (!recvd) { // nothing left on the socket
+        break;
+      }
+      recvd = m_subscriber.recv(msg, zmq::recv_flags::dontwait);
+      if (!recvd || *recvd == 0) {
+        //empty message for establishing connections
+        m_rcvd_zero++;
+        TLOG_DEBUG(1) << "No data received, moving to next message";
+        continue;
+      }
+      m_payload_pool[n_loaded].load_message(msg.data(), msg.size());
+      m_packetsizesum += msg.size(); //sum of data from packets
+      m_packetsize = msg.size(); //last packet size
+      ++n_loaded;
+    }
+    return n_loaded;
+  }
+
+  // Hands the first n_loaded pool payloads over to the sink queue
+  void flush_payloads(size_t n_loaded) {
+    for (size_t i = 0; i < n_loaded; ++i) {
+      m_timestamp = m_payload_pool[i].get_timestamp();
+      try {
+        m_sink_queue->send(std::move(m_payload_pool[i]), m_sink_timeout);
+      } catch (const iomanager::TimeoutExpired& ex) {
+        ers::warning(ex);
+      }
+      m_packetCounter++;
+    }
+  }
 };
   
 } // namespace dunedaq::lbrulibs
@@ -74,6 +74,7 @@ public:
       m_queue_timeout = std::chrono::milliseconds(m_cfg.zmq_receiver_timeout);
       TLOG_DEBUG(5) << "ZMQLinkModel conf: initialising subscriber!";
       m_subscriber_connected = false;
+      setup_socket();
       m_subscriber.set(zmq::sockopt::subscribe, "");
       TLOG_DEBUG(5) << "ZMQLinkModel conf: connecting subscriber!";
       m_subscriber.connect(m_ZMQLink_sourceLink);
@@ -184,6 +185,7 @@ private:
   void process_ZMQLink() {
 
     TLOG_DEBUG(1) << "Starting ZMQ link process";
+    pin_current_thread();
 
     
     std::ostringstream oss;
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Checks that the larpix.c bulk walkers in larpixtools decode the PACMAN
+# messages of a larpix HDF5 file exactly like the pure python larpixtools path
+# (parse_msg / Packet_v2) and the numpy fallback.
+import sys
+import argparse
+import numpy as np
+sys.path.insert(1, '../scripts')
+import larpixtools
+
+def main(input_file, max_msgs):
+    msgs, msg_offsets = larpixtools.pacman_msg_cache(input_file)
+    msgs = np.asarray(msgs[:msg_offsets[min(max_msgs, len(msg_offsets) - 1)]])
+
+    if larpixtools.load_larpix_c() is None:
+        print("larpix.c could not be built, only the numpy fallback is available")
+        return 1
+    words, msg_index, unix_ts = larpixtools.walk_msgs(msgs)
+    fields = larpixtools.decode_packet_fields(words['packet'])
+
+    # numpy fallback
+    larpixtools._larpix_c_lib = False
+    fb_words, fb_msg_index, fb_unix_ts = larpixtools.walk_msgs(msgs)
+    fb_fields = larpixtools.decode_packet_fields(words['packet'])
+    larpixtools._larpix_c_lib = None
+    errors = 0
+    for name, c, fb in (('words', words, fb_words), ('msg_index', msg_index, fb_msg_index),
+            ('unix_ts', unix_ts, fb_unix_ts)):
+        if not np.array_equal(c, fb):
+            print("Mismatch with numpy fallback:", name)
+            errors += 1
+    for name in fields:
+        if not np.array_equal(fields[name], fb_fields[name]):
+            print("Mismatch with numpy fallback: packet", name)
+            errors += 1
+
+    # struct/Packet_v2 reference
+    i = 0
+    for i_msg, msg in enumerate(larpixtools.iter_msgs(msgs, msg_offsets)):
+        if i_msg >= max_msgs:
+            break
+        header, msg_words = larpixtools.parse_msg(bytes(msg))
+        for word in msg_words:
+            if word[0] != 'DATA':
+                i += 1
+                continue
+            packet = larpixtools.Packet_v2(word[-1])
+            expected = dict(io_channel=word[1], receipt_timestamp=word[2],
+                unix_ts=header[1], packet_type=packet.packet_type,
+                chip_id=packet.chip_id, channel_id=packet.channel_id,
+                timestamp=packet.timestamp, first_packet=packet.first_packet,
+                dataword=packet.dataword, trigger_type=packet.trigger_type,
+                local_fifo=packet.local_fifo, shared_fifo=packet.shared_fifo,
+                downstream_marker=packet.downstream_marker, parity=packet.parity)
+            found = dict(io_channel=words['io_channel'][i],
+                receipt_timestamp=words['receipt_timestamp'][i], unix_ts=unix_ts[i],
+                **dict((name, fields[name][i]) for name in fields))
+            for name, value in expected.items():
+                if found[name] != value:
+                    print("Mismatch in message", i_msg, "word", i, name, found[name], "!=", value)
+                    errors += 1
+            i += 1
+    print("Checked", i, "words in", min(max_msgs, len(msg_offsets) - 1), "messages:",
+        "OK" if errors == 0 else "{} mismatches".format(errors))
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_file', default='example-pacman-data.h5')
+    parser.add_argument('--max_msgs', type=int, default=5000)
+    args = parser.parse_args()
+    sys.exit(main(args.input_file, args.max_msgs))
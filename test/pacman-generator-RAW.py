@@ -3,8 +3,10 @@ import argparse
 import time
 import sys
 import multiprocessing
+import threading
 #import h5py
 import random
+import numpy as np
 
 #larpix imports
 sys.path.insert(1, '../scripts')
@@ -19,41 +21,12 @@ cmd = 'tcp://127.0.0.1:5555'
 data = 'tcp://127.0.0.1:5556'
 
 
-# Converts HDF5 files into a list of PACMAN messegaes (bytes)
+# Converts HDF5 files into PACMAN messages (bytes), cached on disk between runs
 def hdf5ToPackets(datafile): 
     print("Reading from:",datafile)
-    packets = larpixtools.from_file(datafile)['packets'] #read from HDF5 file
-    print("Separating into messages based on timestamp packets...")
-    msg_breaks = [i for i in range(len(packets)) if packets[i].packet_type == 0 or i == len(packets)-1] #find the timestamp packets which signify message breaks
-    msg_packets = [packets[i:j] for i,j in zip(msg_breaks[:-1], msg_breaks[1:])] #separate into messages
-    msgs = [larpixtools.format(p, msg_type='DATA') for p in msg_packets]
-    print("Extracting headers and words from messages...")
-    #header_list = [pacman_msg_format.parse_msg(p)[0] for p in msgs] #retrieve headers
-    word_lists = [larpixtools.parse_msg(p)[1] for p in msgs] #retrieve lists of words from each message
-    
-    '''
-    # Deprecated method of making messages
-    messages = []
-    print("Creating a message every second...")
-    for i in msg_packets:
-        messages.append(pacman_msg_format.format(i, msg_type='DATA'))
-        print(pacman_msg_format.parse(pacman_msg_format.format(i, msg_type='DATA')))
-        time.sleep(1)
-    '''
-
-    '''
-    # Modern method of making messages
-    messages = []
-    print("Creating a message every second...")
-    for i in word_lists:
-        messages.append(pacman_msg_format.format_msg('DATA',i))
-        print(pacman_msg_format.parse_msg(pacman_msg_format.format_msg('DATA',i)))
-        time.sleep(1)
-    print("Messages created.")
-    '''
-
-    print("Read complete. PACMAN style messages prepared.")
-    return word_lists
+    messages = larpixtools.pacman_msg_cache(datafile)
+    print("Read complete. %d PACMAN style messages prepared." %(len(messages[1])-1))
+    return messages
 
 # Useful print message for the user which tells them what they are about to run.
 def print_explain_modes():
@@ -76,12 +49,22 @@ def print_explain_modes():
           Running mode 4:
           For each loop of the input file you will send 50 total messages in groups of 5
           spaced by 1 second.
-          If you specified --n_messages_total, --n_messages_group or --group_interval, this will be ignored.
+          If you specified --n_messages_total, --n_messages_group or --group_interval, this will be ignored.\n
+          Running mode 5:
+          For each loop of the input file you will send all of the messages at a fixed rate of
+          --rate messages/s (or --rate_mb MB/s if given), in batches of --batch_size messages.\n
+          Running mode 6:
+          For each loop of the input file you will send all of the messages as fast as possible,
+          in batches of --batch_size messages.\n
+          Running mode 7:
+          For each loop of the input file you will send all of the messages spaced as their original
+          receipt timestamps (ticks of --clock_hz), sped up by --speed.\n
+          Modes 5 to 7 report the achieved throughput and pacing jitter at the end.
           """)
     sys.exit()
     return
 
-def print_mode_info (mode, this_n_messages_total, this_n_messages_group, this_group_interval):
+def print_mode_info (mode, this_n_messages_total, this_n_messages_group, this_group_interval, rate=0, rate_mb=0, speed=1.0, batch_size=1):
     
     s_print = "\n\n\n Running mode " + str(mode) + "\n" 
     if mode == 0:
@@ -107,13 +90,129 @@ def print_mode_info (mode, this_n_messages_total, this_n_messages_group, this_gr
                    spaced by 1 second.
                    If you specified --n_messages_total, --n_messages_group or --group_interval, this will be ignored.
                    \n\n\n"""
+    elif mode == 5:
+        if rate_mb > 0:
+            s_print += " For each loop of the input file you will send all messages at " + str(rate_mb) + " MB/s"
+        else:
+            s_print += " For each loop of the input file you will send all messages at " + str(rate) + " messages/s"
+        s_print += " in batches of " + str(batch_size) + ".\n\n\n"
+    elif mode == 6:
+        s_print += " For each loop of the input file you will send all messages as fast as possible"
+        s_print += " in batches of " + str(batch_size) + ".\n\n\n"
+    elif mode == 7:
+        s_print += " For each loop of the input file you will send all messages at their original receipt timestamp"
+        s_print += " spacing sped up by " + str(speed) + ".\n\n\n"
 
     print(s_print)
     return
 
 
+# Token bucket on the monotonic clock, refilled at rate tokens/s up to burst
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    # Blocks until n tokens can be taken, returns the time they became available
+    def take(self, n):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+        ready = now
+        if self.tokens < n:
+            ready = now + (n - self.tokens)/self.rate
+            time.sleep(ready - now)
+        self.tokens -= n
+        return ready
+
+# Receipt time in seconds of the first timestamped DATA word of each message
+# relative to the first message, messages without one inherit the time of the
+# previous message. Files without receipt timestamps fall back to the header
+# unix_ts (whole seconds).
+def msg_receipt_times(messages, clock_hz):
+    msgs, msg_offsets = messages
+    n_msgs = len(msg_offsets) - 1
+    words, msg_index, unix_ts = larpixtools.walk_msgs(msgs)
+    timed = (words['word_type'] == larpixtools.WORD_TYPE_DATA) & (words['receipt_timestamp'] != 0)
+    if timed.any():
+        timed_msgs, first = np.unique(msg_index[timed], return_index=True)
+        ticks = words['receipt_timestamp'][timed][first].astype(np.int64)
+    else:
+        # headers hold the unix time of the file's timestamp packets (see hdf5_to_msgs)
+        print("Warning: no receipt timestamps in the messages, pacing on the header unix_ts (1 s resolution)")
+        timed_msgs, first = np.unique(msg_index, return_index=True)
+        ticks = unix_ts[first].astype(np.int64) * int(clock_hz)
+    # clock resets and rollovers restart the spacing from zero
+    times = np.concatenate([[0], np.cumsum(np.clip(np.diff(ticks), 0, None))])/clock_hz
+    if len(times) == 0 or times[-1] == 0:
+        print("Warning: all message times are equal, mode 7 needs receipt timestamps or timestamp packets in the file to pace, sending without pacing")
+        return np.zeros(n_msgs)
+    idx = np.maximum(np.searchsorted(timed_msgs, np.arange(n_msgs), side='right') - 1, 0)
+    return times[idx]
+
+# Paced replay of all messages (modes 5-7), prints throughput and jitter at the end
+def replay(data_socket, id, messages, mode, n_file_evals, rate, rate_mb, speed, batch_size, clock_hz):
+    msgs, msg_offsets = messages
+    n_msgs = len(msg_offsets) - 1
+    msg_bytes = np.diff(msg_offsets)
+
+    # block instead of timing out while the receiver is slow (once the
+    # socket's SNDHWM messages are queued)
+    data_socket.setsockopt(zmq.SNDTIMEO, -1)
+
+    bucket = None
+    if mode == 5:
+        if rate_mb > 0:
+            bucket = TokenBucket(rate_mb*1e6, msg_bytes[:batch_size].sum())
+        else:
+            bucket = TokenBucket(rate, batch_size)
+    if mode == 7:
+        schedule = msg_receipt_times(messages, clock_hz)/speed
+
+    lateness = []
+    n_sent = 0
+    n_bytes = 0
+    start_time = time.monotonic()
+    for n in range(n_file_evals):
+        loop_time = time.monotonic()
+        for first in range(0, n_msgs, batch_size):
+            last = min(first + batch_size, n_msgs)
+            target = None
+            if bucket is not None:
+                target = bucket.take(msg_bytes[first:last].sum() if rate_mb > 0 else last - first)
+            elif mode == 7:
+                target = loop_time + schedule[first]
+                wait = target - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            if target is not None:
+                lateness.append(time.monotonic() - target)
+
+            # restamp a copy of the batch, the cached messages are shared read-only
+            batch, batch_offsets = larpixtools.copy_msgs(msgs, msg_offsets, first, last)
+            view = memoryview(batch)
+            for i in range(last - first):
+                # blocking send, retrying a timed out multipart could resend
+                # the routing id frame into the TCP stream
+                data_socket.send_multipart([id,view[batch_offsets[i]:batch_offsets[i+1]]])
+            n_sent += last - first
+            n_bytes += int(msg_bytes[first:last].sum())
+    elapsed = time.monotonic() - start_time
+
+    print("Sent %d messages (%d bytes) in %.3f s" %(n_sent, n_bytes, elapsed))
+    if elapsed > 0:
+        print("Achieved rate: %.1f messages/s, %.3f MB/s" %(n_sent/elapsed, n_bytes/elapsed/1e6))
+    if len(lateness) > 0:
+        lateness = np.array(lateness)*1e3
+        print("Pacing jitter (send time - target time): mean %.3f ms, std %.3f ms, p99 %.3f ms, max %.3f ms"
+              %(lateness.mean(), lateness.std(), np.percentile(lateness, 99), lateness.max()))
+
+
 # Instance of a PACMAN card
-def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_total,n_messages_group,group_interval,n_file_evals=1):
+def pacman(_echo_server,_cmd_server,_data_server,messages,mode,n_messages_total,n_messages_group,group_interval,n_file_evals=1,
+           rate=1000.0,rate_mb=0.0,speed=1.0,batch_size=1,clock_hz=1e7,sndhwm=1000,card=0,start_barrier=None,barrier_timeout=60.0):
     try:
         # Set up sockets
         print("Setting up ZMQ sockets...")
@@ -122,7 +221,8 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
         socket_opts = [
             (zmq.LINGER,100),
             (zmq.RCVTIMEO,100),
-            (zmq.SNDTIMEO,100)
+            (zmq.SNDTIMEO,100),
+            (zmq.SNDHWM,sndhwm)
         ]
         print("Parsing socket options...")
         for opt in socket_opts:
@@ -142,8 +242,13 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
                 time.sleep(1) #wait 1s before retrying
                 continue
 
-        print('Press any key to start sending data...')
-        input()
+        if start_barrier is None:
+            print('Press any key to start sending data...')
+            input()
+        else:
+            print("PACMAN card %i connected to %s, waiting for the other cards..." %(card, _data_server))
+            start_barrier.wait(barrier_timeout) # all cards connected
+            start_barrier.wait() # start sending, released or aborted by main
         print('Initialising...')
         time.sleep(1)
         print("Data will repeat %i times." %(n_file_evals-1))
@@ -157,7 +262,8 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
         # MODE 2: Single message.
         # MODE 3: 10 total message sent individually at intervals of 1 second.
         # MODE 4: 50 total message sent in groups of 5 at intervals of 1 second.
-        if mode < 3:
+        # MODES 5 AND ABOVE: Paced replay of all messages, see replay().
+        if mode < 3 or mode > 4:
             this_n_messages_total = n_messages_total
             this_n_messages_group = n_messages_group
             this_group_interval   = group_interval
@@ -170,32 +276,37 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
             this_n_messages_group = 5
             this_group_interval   = 1
 
-        print_mode_info (mode, this_n_messages_total, this_n_messages_group, this_group_interval);
+        print_mode_info (mode, this_n_messages_total, this_n_messages_group, this_group_interval, rate, rate_mb, speed, batch_size);
 
-        # Send messages in intervals based on timestamps
-        message_count = 0
+        if mode > 4:
+            replay(data_socket, id, messages, mode, n_file_evals, rate, rate_mb, speed, batch_size, clock_hz)
+        else:
+            # Send messages in intervals based on timestamps
+            message_count = 0
         
-        for n in range(n_file_evals):
-            for i in word_lists:
-                #data_socket.send(b"", zmq.SNDMORE)
-                data_socket.send_multipart([id,larpixtools.format_msg('DATA',i)])
-                print(larpixtools.parse_msg(larpixtools.format_msg('DATA',i)))
-                message_count += 1
-                print("Total messages sent:",message_count)
-                if mode == 2: break;
-                elif mode > 0:
-                    if message_count % this_n_messages_total == 0: 
-                        time.sleep(next_sleep);
-                        break;
-                    if message_count % this_n_messages_group == 0: 
-                        next_sleep = this_group_interval;
-                    else: continue;
-                else:
-                    next_sleep = random.randrange(1,3)
-                    if message_count != len(word_lists)*n_file_evals:
-                        print("Next message in: %ds" %(next_sleep))
-
-                time.sleep(next_sleep)
+            for n in range(n_file_evals):
+                for msg in larpixtools.iter_msgs(*messages):
+                    msg = bytearray(msg) # the cached messages are read-only
+                    larpixtools.set_msg_unix_ts(msg)
+                    #data_socket.send(b"", zmq.SNDMORE)
+                    data_socket.send_multipart([id,msg])
+                    print(larpixtools.parse_msg(bytes(msg)))
+                    message_count += 1
+                    print("Total messages sent:",message_count)
+                    if mode == 2: break;
+                    elif mode > 0:
+                        if message_count % this_n_messages_total == 0: 
+                            time.sleep(next_sleep);
+                            break;
+                        if message_count % this_n_messages_group == 0: 
+                            next_sleep = this_group_interval;
+                        else: continue;
+                    else:
+                        next_sleep = random.randrange(1,3)
+                        if message_count != (len(messages[1])-1)*n_file_evals:
+                            print("Next message in: %ds" %(next_sleep))
+
+                    time.sleep(next_sleep)
             
         print("Sleeping for 10 seconds before exiting...")
         time.sleep(10)
@@ -208,24 +319,67 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
         ctx.destroy()
 
 
-def main(s_in_file, mode, n_file_evals, n_pacman, n_messages_total, n_messages_group, group_interval, explain_modes):
+# Emulated PACMAN card running in its own process. The messages are mapped
+# read-only from the on-disk cache, so all cards share the same pages. A card
+# that fails breaks the start barrier so that main and the other cards stop
+# waiting for it.
+def pacman_card(datafile, card, _data_server, start_barrier, barrier_timeout, *args):
+    try:
+        messages = larpixtools.pacman_msg_cache(datafile)
+        pacman(echo, cmd, _data_server, messages, *args, card=card, start_barrier=start_barrier,
+               barrier_timeout=barrier_timeout)
+    except threading.BrokenBarrierError:
+        print("PACMAN card %i: start cancelled" %(card))
+        sys.exit(1)
+    except:
+        start_barrier.abort()
+        raise
+
+
+def main(s_in_file, mode, n_file_evals, n_pacman, n_messages_total, n_messages_group, group_interval, explain_modes,
+         rate=1000.0, rate_mb=0.0, speed=1.0, batch_size=1, clock_hz=1e7, port_stride=0, sndhwm=1000, barrier_timeout=60.0):
 
     if(explain_modes): print_explain_modes()
     if(s_in_file == "ns"):
         print("\n\n\nPlease specify an input file...")
         sys.exit()
 
-    # Fetch messages and timestamps
-    word_lists = hdf5ToPackets(s_in_file)
+    # Fetch messages and timestamps (fills the message cache used by the cards)
+    hdf5ToPackets(s_in_file)
     print("Starting PACMAN card(s)")
     start_time = time.time()
-    # Start PACMAN cards
+    # Start PACMAN cards, each with its own socket and (with --port_stride) endpoint
     def start(task, *args):
         process = multiprocessing.Process(target=task, args=args)
         process.daemon = True
         process.start()
+        return process
+    data_host, data_port = data.rsplit(':', 1)
+    start_barrier = multiprocessing.Barrier(n_pacman + 1)
+    processes = []
     for i in range(n_pacman):
-        start(pacman(echo,cmd,data,word_lists,mode,n_messages_total,n_messages_group,group_interval,n_file_evals), i)
+        data_server = '%s:%i' %(data_host, int(data_port) + i*port_stride)
+        processes.append(start(pacman_card, s_in_file, i, data_server, start_barrier, barrier_timeout,
+                               mode,n_messages_total,n_messages_group,group_interval,n_file_evals,
+                               rate,rate_mb,speed,batch_size,clock_hz,sndhwm))
+    try:
+        start_barrier.wait(barrier_timeout)
+        print('All %i PACMAN card(s) connected. Press any key to start sending data...' %(n_pacman))
+        input()
+        start_barrier.wait(barrier_timeout)
+    except threading.BrokenBarrierError:
+        print("Not all PACMAN cards connected within %.0f s or one of them failed, stopping." %(barrier_timeout))
+        start_barrier.abort()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        sys.exit(1)
+    for process in processes:
+        process.join()
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        print("PACMAN card(s) %s exited with an error" %(failed))
     print("Total elapsed time:",time.time()-start_time)
 
 
@@ -234,12 +388,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser();
     parser.add_argument('--explain_modes',    dest='explain_modes', action='store_true', help="Print an explanation of the running modes.")
     parser.add_argument('--input_file', '-i', dest='input_file',   type=str, default="ns",  help='Input h5 file.')
-    parser.add_argument('--mode',             dest='mode',         type=int, default=0,     help='Running mode, can take values [0-4]. Pass --explain_modes to this script for a full explanation of different modes.')
+    parser.add_argument('--mode',             dest='mode',         type=int, default=0,     help='Running mode, can take values [0-7]. Pass --explain_modes to this script for a full explanation of different modes.')
     parser.add_argument('--n_file_evals',     dest='n_file_evals', type=int, default=1,     help='Number of times the input file is looped through.')
     parser.add_argument('--n_pacman',         dest='n_pacman',     type=int, default=1,     help='Number of PACMAN cards.')
     parser.add_argument('--n_messages_total', dest='n_messages_total', type=int,   default=10,  help='To be used with --mode 1. Total number of messages sent during one loop of input file.')
     parser.add_argument('--n_messages_group', dest='n_messages_group', type=int,   default=1,   help='To be used with --mode 1. Total number of messages sent at once at intervals of --group_interval.')
     parser.add_argument('--group_interval',   dest='group_interval',   type=float, default=1.0, help='To be used with --mode 1. Time interval between groups of messages being sent.')
+    parser.add_argument('--rate',             dest='rate',             type=float, default=1000.0, help='To be used with --mode 5. Messages sent per second.')
+    parser.add_argument('--rate_mb',          dest='rate_mb',          type=float, default=0.0, help='To be used with --mode 5. MB sent per second, overrides --rate if given.')
+    parser.add_argument('--speed',            dest='speed',            type=float, default=1.0, help='To be used with --mode 7. Speed up factor applied to the original message spacing.')
+    parser.add_argument('--batch_size',       dest='batch_size',       type=int,   default=1,   help='To be used with --mode 5-7. Number of messages sent per pacing step.')
+    parser.add_argument('--clock_hz',         dest='clock_hz',         type=float, default=1e7, help='To be used with --mode 7. Clock frequency of the receipt timestamps.')
+    parser.add_argument('--sndhwm',           dest='sndhwm',           type=int,   default=1000, help='To be used with --mode 5-7. Messages queued for a slow receiver before sends block.')
+    parser.add_argument('--barrier_timeout',  dest='barrier_timeout',  type=float, default=60.0, help='Seconds to wait for all PACMAN cards to connect before giving up.')
+    parser.add_argument('--port_stride',      dest='port_stride',      type=int,   default=0,   help='Port offset between the data endpoints of consecutive PACMAN cards. With 0 all cards connect to the same endpoint, to read each card on its own link match the --port-stride of app_confgen.py.')
     args = parser.parse_args();
 
-    main(args.input_file, args.mode, args.n_file_evals, args.n_pacman, args.n_messages_total, args.n_messages_group, args.group_interval, args.explain_modes);
+    main(args.input_file, args.mode, args.n_file_evals, args.n_pacman, args.n_messages_total, args.n_messages_group, args.group_interval, args.explain_modes,
+         args.rate, args.rate_mb, args.speed, args.batch_size, args.clock_hz, args.port_stride, args.sndhwm, args.barrier_timeout);
@@ -3,6 +3,7 @@ import argparse
 import time
 import sys
 import multiprocessing
+import threading
 #import h5py
 import random
 
@@ -19,41 +20,12 @@ cmd = 'tcp://127.0.0.1:5555'
 data = 'tcp://127.0.0.1:5556'
 
 
-# Converts HDF5 files into a list of PACMAN messegaes (bytes)
+# Converts HDF5 files into PACMAN messages (bytes), cached on disk between runs
 def hdf5ToPackets(datafile): 
     print("Reading from:",datafile)
-    packets = larpixtools.from_file(datafile)['packets'] #read from HDF5 file
-    print("Separating into messages based on timestamp packets...")
-    msg_breaks = [i for i in range(len(packets)) if packets[i].packet_type == 0 or i == len(packets)-1] #find the timestamp packets which signify message breaks
-    msg_packets = [packets[i:j] for i,j in zip(msg_breaks[:-1], msg_breaks[1:])] #separate into messages
-    msgs = [larpixtools.format(p, msg_type='DATA') for p in msg_packets]
-    print("Extracting headers and words from messages...")
-    #header_list = [pacman_msg_format.parse_msg(p)[0] for p in msgs] #retrieve headers
-    word_lists = [larpixtools.parse_msg(p)[1] for p in msgs] #retrieve lists of words from each message
-    
-    '''
-    # Deprecated method of making messages
-    messages = []
-    print("Creating a message every second...")
-    for i in msg_packets:
-        messages.append(pacman_msg_format.format(i, msg_type='DATA'))
-        print(pacman_msg_format.parse(pacman_msg_format.format(i, msg_type='DATA')))
-        time.sleep(1)
-    '''
-
-    '''
-    # Modern method of making messages
-    messages = []
-    print("Creating a message every second...")
-    for i in word_lists:
-        messages.append(pacman_msg_format.format_msg('DATA',i))
-        print(pacman_msg_format.parse_msg(pacman_msg_format.format_msg('DATA',i)))
-        time.sleep(1)
-    print("Messages created.")
-    '''
-
-    print("Read complete. PACMAN style messages prepared.")
-    return word_lists
+    messages = larpixtools.pacman_msg_cache(datafile)
+    print("Read complete. %d PACMAN style messages prepared." %(len(messages[1])-1))
+    return messages
 
 # Useful print message for the user which tells them what they are about to run.
 def print_explain_modes():
@@ -113,7 +85,7 @@ def print_mode_info (mode, this_n_messages_total, this_n_messages_group, this_gr
 
 
 # Instance of a PACMAN card
-def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_total,n_messages_group,group_interval,n_file_evals=1):
+def pacman(_echo_server,_cmd_server,_data_server,messages,mode,n_messages_total,n_messages_group,group_interval,n_file_evals=1,card=0,start_barrier=None,barrier_timeout=60.0):
     try:
         # Set up sockets
         print("Setting up ZMQ sockets...")
@@ -150,8 +122,13 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
             cmd_socket.send(b'')
         '''
         
-        print('Press any key to start sending data...')
-        input()
+        if start_barrier is None:
+            print('Press any key to start sending data...')
+            input()
+        else:
+            print("PACMAN card %i bound to %s, waiting for the other cards..." %(card, _data_server))
+            start_barrier.wait(barrier_timeout) # all cards bound
+            start_barrier.wait() # start sending, released or aborted by main
         print('Initialising...')
         time.sleep(1)
         #print("Data will repeat %i times." %(n_file_evals-1))
@@ -185,10 +162,12 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
         message_count = 0
         
         for n in range(n_file_evals):
-            for i in word_lists:
+            for msg in larpixtools.iter_msgs(*messages):
+                msg = bytearray(msg) # the cached messages are read-only
+                larpixtools.set_msg_unix_ts(msg)
                 #data_socket.send(b"", zmq.SNDMORE)
-                data_socket.send(larpixtools.format_msg('DATA',i))
-                print(larpixtools.parse_msg(larpixtools.format_msg('DATA',i)))
+                data_socket.send(msg)
+                print(larpixtools.parse_msg(bytes(msg)))
                 message_count += 1
                 print("Total messages sent:",message_count)
                 if mode == 2: break;
@@ -201,7 +180,7 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
                     else: continue;
                 else:
                     next_sleep = random.randrange(1,3)
-                    if message_count != len(word_lists)*n_file_evals:
+                    if message_count != (len(messages[1])-1)*n_file_evals:
                         print("Next message in: %ds" %(next_sleep))
 
                 time.sleep(next_sleep)
@@ -217,24 +196,72 @@ def pacman(_echo_server,_cmd_server,_data_server,word_lists,mode,n_messages_tota
         ctx.destroy()
 
 
-def main(s_in_file, mode, n_file_evals, n_pacman, n_messages_total, n_messages_group, group_interval, explain_modes):
+# Emulated PACMAN card running in its own process. The messages are mapped
+# read-only from the on-disk cache, so all cards share the same pages. A card
+# that fails breaks the start barrier so that main and the other cards stop
+# waiting for it.
+def pacman_card(datafile, card, servers, start_barrier, barrier_timeout, *args):
+    try:
+        messages = larpixtools.pacman_msg_cache(datafile)
+        pacman(*servers, messages, *args, card=card, start_barrier=start_barrier,
+               barrier_timeout=barrier_timeout)
+    except threading.BrokenBarrierError:
+        print("PACMAN card %i: start cancelled" %(card))
+        sys.exit(1)
+    except:
+        start_barrier.abort()
+        raise
+
+
+def main(s_in_file, mode, n_file_evals, n_pacman, n_messages_total, n_messages_group, group_interval, explain_modes,
+         port_stride=10, barrier_timeout=60.0):
 
     if(explain_modes): print_explain_modes()
     if(s_in_file == "ns"):
         print("\n\n\nPlease specify an input file...")
         sys.exit()
 
-    # Fetch messages and timestamps
-    word_lists = hdf5ToPackets(s_in_file)
+    if n_pacman > 1 and port_stride == 0:
+        print("\n\n\nPlease specify a non-zero --port_stride, every PACMAN card binds its own ports...")
+        sys.exit()
+
+    # Fetch messages and timestamps (fills the message cache used by the cards)
+    hdf5ToPackets(s_in_file)
     print("Starting PACMAN card(s)")
     start_time = time.time()
-    # Start PACMAN cards
+    # Start PACMAN cards, each with its own sockets and ports
     def start(task, *args):
         process = multiprocessing.Process(target=task, args=args)
         process.daemon = True
         process.start()
+        return process
+    def offset_port(server, offset):
+        host, port = server.rsplit(':', 1)
+        return '%s:%i' %(host, int(port) + offset)
+    start_barrier = multiprocessing.Barrier(n_pacman + 1)
+    processes = []
     for i in range(n_pacman):
-        start(pacman(echo,cmd,data,word_lists,mode,n_messages_total,n_messages_group,group_interval,n_file_evals), i)
+        servers = [offset_port(server, i*port_stride) for server in (echo, cmd, data)]
+        processes.append(start(pacman_card, s_in_file, i, servers, start_barrier, barrier_timeout,
+                               mode,n_messages_total,n_messages_group,group_interval,n_file_evals))
+    try:
+        start_barrier.wait(barrier_timeout)
+        print('All %i PACMAN card(s) ready. Press any key to start sending data...' %(n_pacman))
+        input()
+        start_barrier.wait(barrier_timeout)
+    except threading.BrokenBarrierError:
+        print("Not all PACMAN cards bound within %.0f s or one of them failed, stopping." %(barrier_timeout))
+        start_barrier.abort()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        sys.exit(1)
+    for process in processes:
+        process.join()
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        print("PACMAN card(s) %s exited with an error" %(failed))
     print("Total elapsed time:",time.time()-start_time)
 
 
@@ -249,7 +276,10 @@ if __name__ == "__main__":
     parser.add_argument('--n_messages_total', dest='n_messages_total', type=int,   default=10,  help='To be used with --mode 1. Total number of messages sent during one loop of input file.')
     parser.add_argument('--n_messages_group', dest='n_messages_group', type=int,   default=1,   help='To be used with --mode 1. Total number of messages sent at once at intervals of --group_interval.')
     parser.add_argument('--group_interval',   dest='group_interval',   type=float, default=1.0, help='To be used with --mode 1. Time interval between groups of messages being sent.')
+    parser.add_argument('--barrier_timeout',  dest='barrier_timeout',  type=float, default=60.0, help='Seconds to wait for all PACMAN cards to bind before giving up.')
+    parser.add_argument('--port_stride',      dest='port_stride',      type=int,   default=10,  help='Port offset between the endpoints of consecutive PACMAN cards, match the --port-stride of app_confgen.py.')
     args = parser.parse_args();
 
-    main(args.input_file, args.mode, args.n_file_evals, args.n_pacman, args.n_messages_total, args.n_messages_group, args.group_interval, args.explain_modes);
+    main(args.input_file, args.mode, args.n_file_evals, args.n_pacman, args.n_messages_total, args.n_messages_group, args.group_interval, args.explain_modes,
+         args.port_stride, args.barrier_timeout);
 
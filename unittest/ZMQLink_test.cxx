@@ -82,7 +82,7 @@ BOOST_AUTO_TEST_CASE(LinkTest)
   const nlohmann::json theInfo = ci.get_collected_infos();
 
   try{
-    int numPackets = theInfo.at("__properties").at("dunedaq.lbrulibs.pacmancardreaderinfo.ZMQLinkInfo").at("__data").at("num_packets_received");
+    int numPackets = theInfo.at("__children").at("link_0").at("__properties").at("dunedaq.lbrulibs.pacmancardreaderinfo.ZMQLinkInfo").at("__data").at("num_packets_received");
     BOOST_REQUIRE(numPackets==1);
   }
   catch(std::exception& e){